@@ -18,11 +18,54 @@ import argparse
 import numpy as np
 import scipy.io as sio
 import math as mt
-from scipy.fftpack import fft
-from scipy.fftpack import fftshift
-from scipy.signal.windows import hann
 import pickle
 import os
+from mat_utility import load_rows
+from storage_utility import SanitizedCsi
+from band_utility import band_plan_of
+from doppler_utility import band_profiles, normalize_profiles, velocity_bins
+
+
+def load_normalized_csi(exp_dir, name, packets, bands):
+    # complex CSI of the reconstruction (<name>.npz or <name>.mat) for the packets in the range, with the amplitude
+    # normalized by the mean over all the subcarriers of each packet. Only the subcarriers from the first to the last
+    # of the bands (bandwidth, sub_band) are returned, together with the columns of each band in them
+    if os.path.exists(exp_dir + name + '.npz'):
+        sanitized_csi = SanitizedCsi(exp_dir + name + '.npz')
+        plan = band_plan_of(sanitized_csi.header['n_subcarriers'], grid='trimmed')
+        columns, bands_columns = bands_span(plan, bands)
+        csi_matrix_complete = sanitized_csi.csi(packets)[:, columns] / sanitized_csi.amplitude_mean(packets)[:, None]
+        sanitized_csi.close()
+    else:
+        # only the packets in the range are read
+        csi_matrix_processed = load_rows(exp_dir + name + '.mat', 'csi_matrix_processed', packets)
+        plan = band_plan_of(csi_matrix_processed.shape[1], grid='trimmed')
+        columns, bands_columns = bands_span(plan, bands)
+        csi_amplitude = csi_matrix_processed[:, :, 0]
+        csi_amplitude = csi_amplitude[:, columns] / np.mean(csi_amplitude, axis=1, keepdims=True)
+        csi_matrix_complete = csi_amplitude * np.exp(1j * csi_matrix_processed[:, columns, 1])
+    return csi_matrix_complete, bands_columns
+
+
+def capture_plan(exp_dir, name):
+    # band plan of the reconstruction (<name>.npz or <name>.mat) from the header of the file, without reading the CSI
+    if os.path.exists(exp_dir + name + '.npz'):
+        sanitized_csi = SanitizedCsi(exp_dir + name + '.npz')
+        n_subcarriers = sanitized_csi.header['n_subcarriers']
+        sanitized_csi.close()
+    else:
+        variables = sio.whosmat(exp_dir + name + '.mat')
+        n_subcarriers = [shape for variable, shape, _ in variables if variable == 'csi_matrix_processed'][0][1]
+    return band_plan_of(n_subcarriers, grid='trimmed')
+
+
+def bands_span(plan, bands):
+    # slice of the trimmed grid from the first to the last subcarrier of the bands and the slices of the bands in it
+    bands_columns = [plan.band_columns(bandwidth, sub_band).indices(plan.n_trimmed)[:2]
+                     for bandwidth, sub_band in bands]
+    first = min(start for start, stop in bands_columns)
+    last = max(stop for start, stop in bands_columns)
+    return slice(first, last), [slice(start - first, stop - first) for start, stop in bands_columns]
 
 
 if __name__ == '__main__':
@@ -36,14 +79,41 @@ if __name__ == '__main__':
     parser.add_argument('sliding', help='Number of packet for sliding operations', type=int)
     parser.add_argument('noise_level', help='Level for the noise to be removed', type=float)
     parser.add_argument('--bandwidth', help='Bandwidth in [MHz] to select the subcarriers, can be 20, 40, 80 '
-                                            '(default 80)', default=80, required=False, type=int)
-    parser.add_argument('--sub_band', help='Sub_band idx in [1, 2, 3, 4] for 20 MHz, [1, 2] for 40 MHz '
-                                           '(default 1)', default=1, required=False, type=int)
+                                            'or 160 up to the bandwidth of the capture (default the bandwidth of the '
+                                            'capture)', default=None, required=False, type=int)
+    parser.add_argument('--sub_band', help='Sub_band idx in [1, 2, 3, 4] for 20 MHz, [1, 2] for 40 MHz of an 80 MHz '
+                                           'capture, twice as many sub bands in a 160 MHz capture (default 1)',
+                        default=1, required=False, type=int)
     parser.add_argument('--sub_sampling', help='Sampling in [1, 2, 3, 4, 5]'
                                                '(default 1)', default=1, required=False, type=int)
+    parser.add_argument('--presampled', help='The sub sampling has already been applied in the H estimation '
+                                             '(--sub_sampling of CSI_phase_sanitization_H_estimation.py), start '
+                                             'and end count the packets of the sub-sampled stream',
+                        action='store_true', required=False)
+    parser.add_argument('--workers', help='Number of threads of the FFTs, -1 for all the CPUs (default -1)',
+                        default=-1, required=False, type=int)
+    parser.add_argument('--memory_budget', help='Memory in [MB] for the windows transformed together (default 4)',
+                        default=4, required=False, type=float)
+    parser.add_argument('--configurations', help='Comma separated bandwidth:sub_band:sub_sampling configurations '
+                                                 'computed in one pass over each capture, in place of --bandwidth, '
+                                                 '--sub_band and --sub_sampling (e.g., 80:1:1,40:1:1,40:2:1)',
+                        default=None, required=False)
+    parser.add_argument('--velocity_max', help='Compute only the Doppler bins with velocity up to velocity_max [m/s] '
+                                               'in absolute value (all the 100 bins if not given)', default=None,
+                        required=False, type=float)
     args = parser.parse_args()
 
-    sub_sampling = args.sub_sampling
+    if args.configurations is None:
+        configurations = [(args.bandwidth, args.sub_band, args.sub_sampling)]
+    else:
+        try:
+            configurations = [tuple(int(value) for value in configuration.split(':'))
+                              for configuration in args.configurations.split(',')]
+        except ValueError:
+            parser.error('Configurations must be bandwidth:sub_band:sub_sampling')
+        if any(len(configuration) != 3 for configuration in configurations):
+            parser.error('Configurations must be bandwidth:sub_band:sub_sampling')
+
     num_symbols = args.sample_length
     # num_symbols = mt.ceil(num_symbols / sub_sampling)
 
@@ -53,10 +123,18 @@ if __name__ == '__main__':
     fc = 5785e6
     v_light = 3e8
 
+    # Doppler bins computed, fftshifted bins of the FFT of 100 points
+    n_fft = 100
+    bins = None
+    suffix_velocity = ''
+    if args.velocity_max is not None:
+        bins = velocity_bins(args.velocity_max, n_fft, Tc, fc, v_light)
+        suffix_velocity = '_vmax' + str(args.velocity_max)  # not to collide with the traces of all the bins
+        print('Doppler bins ' + str(bins.start) + ' to ' + str(bins.stop - 1) + ' of ' + str(n_fft) + ', ' +
+              str(bins.stop - bins.start) + ' features')
+
     sliding = args.sliding
     noise_lev = args.noise_level
-    bandwidth = args.bandwidth
-    sub_band = args.sub_band
 
     list_subdir = args.subdirs
 
@@ -67,69 +145,50 @@ if __name__ == '__main__':
 
         exp_dir = args.dir + subdir + '/'
 
+        # outputs of the reconstruction, <name>.npz or <name>.mat
         names = []
         all_files = os.listdir(exp_dir)
         for i in range(len(all_files)):
-            names.append(all_files[i][:-4])
+            if all_files[i][:-4] not in names:
+                names.append(all_files[i][:-4])
 
         for name in names:
-            path_doppler_name = path_doppler + '/' + name + '_bandw' + str(bandwidth) + \
-                                '_RU' + str(sub_band) + \
-                                '_sampling' + str(sub_sampling) + '.txt'
-            if os.path.exists(path_doppler_name):
+            # bandwidth of the capture if not given
+            plan = capture_plan(exp_dir, name)
+            paths_doppler_name = {}
+            for bandwidth, sub_band, sub_sampling in configurations:
+                bandwidth = plan.bandwidth if bandwidth is None else bandwidth
+                path_doppler_name = path_doppler + '/' + name + '_bandw' + str(bandwidth) + \
+                                    '_RU' + str(sub_band) + \
+                                    '_sampling' + str(sub_sampling) + suffix_velocity + '.txt'
+                if not os.path.exists(path_doppler_name):
+                    paths_doppler_name[(bandwidth, sub_band, sub_sampling)] = path_doppler_name
+            if not paths_doppler_name:
                 continue
 
-            print(path_doppler_name)
-            name_file = exp_dir + name + '.mat'
-            mdic = sio.loadmat(name_file)
-            csi_matrix_processed = mdic['csi_matrix_processed']
-
-            csi_matrix_processed = csi_matrix_processed[args.start:-args.end, :, :]
-
-            csi_matrix_processed[:, :, 0] = csi_matrix_processed[:, :, 0] / np.mean(csi_matrix_processed[:, :, 0],
-                                                                                    axis=1,  keepdims=True)
-
-            csi_matrix_complete = csi_matrix_processed[:, :, 0]*np.exp(1j*csi_matrix_processed[:, :, 1])
-
-            if sub_sampling != 1:
-                csi_matrix_complete = csi_matrix_complete[0:-1:sub_sampling, :]
-
-            if bandwidth == 40:
-                if sub_band == 1:
-                    selected_subcarriers_idxs = np.arange(-500, -17, 1) + 500
-                elif sub_band == 2:
-                    selected_subcarriers_idxs = np.arange(17, 500, 1) + 500
-                num_selected_subcarriers = selected_subcarriers_idxs.shape[0]
-                csi_matrix_complete = csi_matrix_complete[:, selected_subcarriers_idxs]
-            elif bandwidth == 20:
-                if sub_band == 1:
-                    selected_subcarriers_idxs = np.arange(-500, -259, 1) + 500
-                elif sub_band == 2:
-                    selected_subcarriers_idxs = np.arange(-258, -17, 1) + 500
-                elif sub_band == 3:
-                    selected_subcarriers_idxs = np.arange(17, 258, 1) + 500
-                elif sub_band == 4:
-                    selected_subcarriers_idxs = np.arange(259, 500, 1) + 500
-                num_selected_subcarriers = selected_subcarriers_idxs.shape[0]
-                csi_matrix_complete = csi_matrix_complete[:, selected_subcarriers_idxs]
-
-            csi_d_profile_list = []
-            for i in range(0, csi_matrix_complete.shape[0]-num_symbols, sliding):
-                csi_matrix_cut = csi_matrix_complete[i:i+num_symbols, :]
-                csi_matrix_cut = np.nan_to_num(csi_matrix_cut)
-
-                hann_window = np.expand_dims(hann(num_symbols), axis=-1)
-                csi_matrix_wind = np.multiply(csi_matrix_cut, hann_window)
-                csi_doppler_prof = fft(csi_matrix_wind, n=100, axis=0)
-                csi_doppler_prof = fftshift(csi_doppler_prof, axes=0)
-
-                csi_d_map = np.abs(csi_doppler_prof * np.conj(csi_doppler_prof))
-                csi_d_map = np.sum(csi_d_map, axis=1)
-                csi_d_profile_list.append(csi_d_map)
-            csi_d_profile_array = np.asarray(csi_d_profile_list)
-            csi_d_profile_array_max = np.max(csi_d_profile_array, axis=1, keepdims=True)
-            csi_d_profile_array = csi_d_profile_array/csi_d_profile_array_max
-            csi_d_profile_array[csi_d_profile_array < mt.pow(10, noise_lev)] = mt.pow(10, noise_lev)
-
-            with open(path_doppler_name, "wb") as fp:  # Pickling
-                pickle.dump(csi_d_profile_array, fp)
+            # the capture is read and normalized once for all the configurations, only the packets start:-end
+            bands = sorted(set((bandwidth, sub_band) for bandwidth, sub_band, _ in paths_doppler_name))
+            csi_matrix_complete, bands_columns = load_normalized_csi(exp_dir, name, slice(args.start, -args.end),
+                                                                     bands)
+
+            # one FFT of each subcarrier for each sub sampling, shared by the bands
+            for sub_sampling in sorted(set(sub_sampling for _, _, sub_sampling in paths_doppler_name)):
+                configurations_sampling = [configuration for configuration in paths_doppler_name
+                                           if configuration[2] == sub_sampling]
+                # presampled: start:-end are already packets of the sub-sampled stream, the last one is kept
+                rows = slice(None)
+                if sub_sampling != 1 and not args.presampled:
+                    rows = slice(0, -1, sub_sampling)
+                csi_d_profiles = band_profiles(csi_matrix_complete[rows], num_symbols, sliding,
+                                               [bands_columns[bands.index(configuration[:2])]
+                                                for configuration in configurations_sampling],
+                                               n_fft=n_fft, workers=args.workers, memory_budget=args.memory_budget,
+                                               bins=bins)
+
+                for configuration, csi_d_profile_array in zip(configurations_sampling, csi_d_profiles):
+                    path_doppler_name = paths_doppler_name[configuration]
+                    print(path_doppler_name)
+                    csi_d_profile_array = normalize_profiles(csi_d_profile_array, noise_lev)
+
+                    with open(path_doppler_name, "wb") as fp:  # Pickling
+                        pickle.dump(csi_d_profile_array, fp)
@@ -44,6 +44,9 @@ if __name__ == '__main__':
                                            '(default 1)', default=1, required=False, type=int)
     parser.add_argument('--sub_sampling', help='Sampling in [1, 2, 3, 4, 5]'
                                                '(default 1)', default=1, required=False, type=int)
+    parser.add_argument('--velocity_max', help='Doppler traces computed with --velocity_max of '
+                                               'CSI_doppler_computation.py (default None, all the 100 bins)',
+                        default=None, required=False, type=float)
     args = parser.parse_args()
 
     bandwidth = args.bandwidth
@@ -51,6 +54,8 @@ if __name__ == '__main__':
     sub_sampling = args.sub_sampling
     noise_lev = args.noise_level
     suffix = '_bandw' + str(bandwidth) + '_RU' + str(sub_band) + '_sampling' + str(sub_sampling)
+    if args.velocity_max is not None:
+        suffix = suffix + '_vmax' + str(args.velocity_max)
 
     labels_activities = args.labels_activities
     csi_label_dict = []
@@ -63,8 +68,7 @@ if __name__ == '__main__':
     save_dir = exp_dir + 'dataset_train_val_test/'
     if not os.path.exists(save_dir):
         os.mkdir(save_dir)
-    path_save = save_dir + str(activities) + '_bandw' + str(bandwidth) + '_RU' + str(sub_band) + \
-                                '_sampling' + str(sub_sampling)
+    path_save = save_dir + str(activities) + suffix
     if os.path.exists(path_save):
         remove_files = glob.glob(path_save + '/*')
         for f in remove_files:
@@ -97,8 +101,7 @@ if __name__ == '__main__':
             csi_matrix = []
             label = convert_to_number(act, csi_label_dict)
             for i_ant in range(n_tot):
-                name_file = exp_dir + name + '/' + name + '_stream_' + str(i_ant) + '_bandw' + str(bandwidth) + \
-                            '_RU' + str(sub_band) + '_sampling' + str(sub_sampling) + '.txt'
+                name_file = exp_dir + name + '/' + name + '_stream_' + str(i_ant) + suffix + '.txt'
                 with open(name_file, "rb") as fp:  # Unpickling
                     stft_sum_1 = pickle.load(fp)
                 stft_sum_1[stft_sum_1 < mt.pow(10, noise_lev)] = mt.pow(10, noise_lev)
@@ -78,6 +78,9 @@ if __name__ == '__main__':
                                            '(default 1)', default=1, required=False, type=int)
     parser.add_argument('--sub_sampling', help='Sampling in [1, 2, 3, 4, 5]'
                                                '(default 1)', default=1, required=False, type=int)
+    parser.add_argument('--velocity_max', help='Doppler traces computed with --velocity_max of '
+                                               'CSI_doppler_computation.py (default None, all the 100 bins)',
+                        default=None, required=False, type=float)
 
     args = parser.parse_args()
 
@@ -85,6 +88,9 @@ if __name__ == '__main__':
     sub_band = args.sub_band
     sub_sampling = args.sub_sampling
     noise_lev = args.noise_level
+    suffix = '_bandw' + str(bandwidth) + '_RU' + str(sub_band) + '_sampling' + str(sub_sampling)
+    if args.velocity_max is not None:
+        suffix = suffix + '_vmax' + str(args.velocity_max)
 
     num_symbols = args.sample_length
     middle = int(mt.floor(num_symbols / 2))
@@ -105,8 +111,7 @@ if __name__ == '__main__':
 
         csi_d_antennas = []
         for i_ant in range(n_tot):
-            path_doppler_name = path_doppler + '/' + subdir + '_stream_' + str(i_ant) + '_bandw' + str(bandwidth) + \
-                        '_RU' + str(sub_band) + '_sampling' + str(sub_sampling) + '.txt'
+            path_doppler_name = path_doppler + '/' + subdir + '_stream_' + str(i_ant) + suffix + '.txt'
 
             print(path_doppler_name)
 
@@ -121,7 +126,6 @@ if __name__ == '__main__':
 
             csi_d_antennas.append(csi_d_profile_array_log)
 
-        name_p = './plots/csi_doppler_activity_' + subdir + '_' + activity + '_bandw' + str(bandwidth) + \
-                 '_RU' + str(sub_band) + '_sampling' + str(sub_sampling) + '.png'
+        name_p = './plots/csi_doppler_activity_' + subdir + '_' + activity + suffix + '.png'
 
         plt_fft_doppler_antennas(csi_d_antennas, sliding, delta_v, name_p)
@@ -0,0 +1,98 @@
+
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import numpy as np
+import os
+import time
+from mat_utility import load_rows
+from storage_utility import SanitizedCsi
+from band_utility import band_plan_of
+from doppler_utility import StreamingDoppler, doppler_profiles, normalize_profiles, velocity_bins
+
+
+def load_sanitized_csi(name_file, packets):
+    # complex CSI (packets, subcarriers of the trimmed grid) of the reconstruction, <name>.npz or <name>.mat
+    if os.path.exists(name_file + '.npz'):
+        sanitized_csi = SanitizedCsi(name_file + '.npz')
+        csi = sanitized_csi.csi(packets)
+        sanitized_csi.close()
+        return csi
+    csi_matrix_processed = load_rows(name_file + '.mat', 'csi_matrix_processed', packets)
+    return csi_matrix_processed[:, :, 0] * np.exp(1j * csi_matrix_processed[:, :, 1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('name_file', help='Reconstructed stream <name_file>.npz or <name_file>.mat replayed packet by '
+                                          'packet')
+    parser.add_argument('start', help='Start processing', type=int)
+    parser.add_argument('end', help='End processing (samples from the end)', type=int)
+    parser.add_argument('sample_length', help='Number of packet in a sample', type=int)
+    parser.add_argument('sliding', help='Number of packet for sliding operations', type=int)
+    parser.add_argument('noise_level', help='Level for the noise to be removed', type=float)
+    parser.add_argument('--bandwidth', help='Bandwidth in [MHz] to select the subcarriers (default the bandwidth of '
+                                            'the capture)', default=None, required=False, type=int)
+    parser.add_argument('--sub_band', help='Sub_band idx (default 1)', default=1, required=False, type=int)
+    parser.add_argument('--velocity_max', help='Compute only the Doppler bins with velocity up to velocity_max [m/s] '
+                                               'in absolute value (all the 100 bins if not given)', default=None,
+                        required=False, type=float)
+    parser.add_argument('--packets_per_push', help='Number of packets given to the streaming computation at a time '
+                                                   '(default 1)', default=1, required=False, type=int)
+    parser.add_argument('--refresh', help='Number of packets between two recomputations of the spectrum of the '
+                                          'streaming computation (default 1000)', default=1000, required=False,
+                        type=int)
+    args = parser.parse_args()
+
+    Tc = 7.5e-3
+    fc = 5785e6
+    v_light = 3e8
+    n_fft = 100
+    bins = None
+    if args.velocity_max is not None:
+        bins = velocity_bins(args.velocity_max, n_fft, Tc, fc, v_light)
+
+    csi = load_sanitized_csi(args.name_file, slice(args.start, -args.end))
+    band_columns = band_plan_of(csi.shape[1], grid='trimmed').band_columns(args.bandwidth, args.sub_band)
+
+    # batch computation, as the Doppler computation
+    time_start = time.time()
+    csi_matrix_complete = csi[:, band_columns] / np.mean(np.abs(csi), axis=1, keepdims=True)
+    csi_d_profile_array = normalize_profiles(doppler_profiles(csi_matrix_complete, args.sample_length, args.sliding,
+                                                              n_fft=n_fft, bins=bins), args.noise_level)
+    time_batch = time.time() - time_start
+
+    # streaming computation, packets_per_push packets at a time
+    streaming_doppler = StreamingDoppler(args.sample_length, args.sliding, args.noise_level, band_columns, n_fft, bins,
+                                         args.refresh)
+    push_times = []
+    csi_d_profiles = []
+    for packet_start in range(0, csi.shape[0], args.packets_per_push):
+        time_start = time.time()
+        csi_d_profiles.append(streaming_doppler.push(csi[packet_start:packet_start + args.packets_per_push]))
+        push_times.append(time.time() - time_start)
+    csi_d_profile_stream = np.concatenate(csi_d_profiles)
+    push_times = np.array(push_times)
+
+    print('%d packets, %d subcarriers, %d profiles of %d bins' % (csi.shape[0], csi_matrix_complete.shape[1],
+                                                                  csi_d_profile_array.shape[0],
+                                                                  csi_d_profile_array.shape[1]))
+    print('%-10s %12s %16s %16s' % ('', 'packets/s', 'p99 push [ms]', 'max push [ms]'))
+    print('%-10s %12.1f' % ('batch', csi.shape[0] / time_batch))
+    print('%-10s %12.1f %16.3f %16.3f' % ('streaming', csi.shape[0] / np.sum(push_times),
+                                          1e3 * np.percentile(push_times, 99), 1e3 * np.max(push_times)))
+    print('packet period %.3f ms, max deviation from the batch profiles %.2e'
+          % (1e3 * Tc, np.max(np.abs(csi_d_profile_stream - csi_d_profile_array), initial=0)))
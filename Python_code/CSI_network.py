@@ -44,6 +44,9 @@ if __name__ == '__main__':
                                            '(default 1)', default=1, required=False, type=int)
     parser.add_argument('--sub_sampling', help='Sampling in [1, 2, 3, 4, 5]'
                                                '(default 1)', default=1, required=False, type=int)
+    parser.add_argument('--velocity_max', help='Doppler traces computed with --velocity_max of '
+                                               'CSI_doppler_computation.py (default None, all the 100 bins)',
+                        default=None, required=False, type=float)
     parser.add_argument('--tensorboard', help='Enable tensorboard (default False=0)', default=0, required=False,
                         type=int)
     args = parser.parse_args()
@@ -77,6 +80,8 @@ if __name__ == '__main__':
     activities = np.asarray(activities)
 
     suffix = '_bandw' + str(bandwidth) + '_RU' + str(sub_band) + '_sampling' + str(sub_sampling)
+    if args.velocity_max is not None:
+        suffix = suffix + '_vmax' + str(args.velocity_max)
     train_test_val_name = 'train_' + str(np.asarray(train_folders)) + '_val_' \
                               + str(np.asarray(val_folders))  + '_test_' + str(np.asarray(test_folders))
     folder_name = args.dir + csi_act + suffix + '/' + train_test_val_name + '/'
@@ -34,6 +34,9 @@ if __name__ == '__main__':
                                            '(default 1)', default=1, required=False, type=int)
     parser.add_argument('--sub_sampling', help='Sampling in [1, 2, 3, 4, 5]'
                                                '(default 1)', default=1, required=False, type=int)
+    parser.add_argument('--velocity_max', help='Doppler traces computed with --velocity_max of '
+                                               'CSI_doppler_computation.py (default None, all the 100 bins)',
+                        default=None, required=False, type=float)
     args = parser.parse_args()
 
     n_antennas = args.n_tot
@@ -53,6 +56,8 @@ if __name__ == '__main__':
     num_act = activities.shape[0]
 
     suffix = '_bandw' + str(bandwidth) + '_RU' + str(sub_band) + '_sampling' + str(sub_sampling)
+    if args.velocity_max is not None:
+        suffix = suffix + '_vmax' + str(args.velocity_max)
 
     folders_idx = list(np.arange(num_folders))
     num_elements_comb = 2
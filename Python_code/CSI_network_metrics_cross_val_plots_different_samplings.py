@@ -40,6 +40,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('activities', help='Activities to be considered')
     parser.add_argument('names_base', help='Names base for the files')
+    parser.add_argument('--velocity_max', help='Doppler traces computed with --velocity_max of '
+                                               'CSI_doppler_computation.py (default None, all the 100 bins)',
+                        default=None, required=False, type=float)
     args = parser.parse_args()
 
     names_string = args.names_base
@@ -74,6 +77,8 @@ if __name__ == '__main__':
         sub_band = 1
         sub_sampling = entry
         suffix = '_bandw' + str(bandwidth) + '_RU' + str(sub_band) + '_sampling' + str(sub_sampling)
+        if args.velocity_max is not None:
+            suffix = suffix + '_vmax' + str(args.velocity_max)
 
         name_file_save = './evaluations/' + args.names_base + '_' + str(csi_act) + '_' + suffix + '.txt'
         try:
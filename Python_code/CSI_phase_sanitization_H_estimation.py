@@ -16,9 +16,337 @@
 
 import argparse
 from optimization_utility import *
+from storage_utility import save_compact_stream, load_signal
+from band_utility import band_plan, band_plan_of
 from os import listdir
 import pickle
 from os import path
+import os
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+
+def refined_window(time_max_r, range_refined_down, range_refined_up, t_min, t_max):
+    return max(time_max_r - range_refined_down, t_min), min(time_max_r + range_refined_up, t_max)
+
+
+def reconstruct_Tr(complex_opt_r_refined, frequency_vector_complete, delta_t_refined, t_window, t_min,
+                   operator='dense'):
+    # Trr_sum = sum_l Tr[:, l] * conj(Tr[:, peak]) with Tr = T * r, i.e. (T r) * conj(T[:, peak] r[peak]), for a
+    # block of packets (columns of complex_opt_r_refined) sharing the refined window: one product for the block
+    # without the (frequencies, paths) temporaries of each packet
+    n_packets = complex_opt_r_refined.shape[1]
+    positions_max_r_refined = np.argmax(abs(complex_opt_r_refined), axis=0)
+    r_max = complex_opt_r_refined[positions_max_r_refined, np.arange(n_packets)]
+
+    if operator == 'fft':
+        T_operator = build_delay_operator_cached(frequency_vector_complete, delta_t_refined, t_window[0], t_window[1])
+        time_matrix_refined = T_operator.time_matrix
+        Tr_sum = T_operator @ complex_opt_r_refined
+        T_max = np.exp(-1j * 2 * np.pi * np.outer(frequency_vector_complete,
+                                                  time_matrix_refined[positions_max_r_refined]))
+    else:
+        T_matrix_refined, time_matrix_refined = build_T_matrix_cached(frequency_vector_complete, delta_t_refined,
+                                                                      t_window[0], t_window[1])
+        Tr_sum = T_matrix_refined @ complex_opt_r_refined
+        T_max = T_matrix_refined[:, positions_max_r_refined]
+    Trr_sum = Tr_sum * np.conj(T_max * r_max)
+
+    start_r_opt = int((time_matrix_refined[0] - t_min) / delta_t_refined)
+    return Trr_sum, start_r_opt
+
+
+def merge_lasso_stats(stats_list):
+    stats = {'method': stats_list[0]['method'], 'packets': 0, 'iterations': 0, 'converged': 0}
+    for stats_i in stats_list:
+        stats['packets'] += stats_i['packets']
+        stats['converged'] += stats_i['converged']
+        stats['iterations'] = max(stats['iterations'], stats_i['iterations'])
+    return stats
+
+
+def estimate_chunk(signal_considered, config):
+    # channel estimation for the packets (columns) of signal_considered, the solvers are created for each chunk so
+    # that the result does not depend on how the packets are split among processes
+    c = config
+    n_packets = signal_considered.shape[1]
+    r_optim = np.zeros((c['r_length'], n_packets), dtype=complex)
+    Tr_matrix = np.zeros((c['frequency_vector_complete'].shape[0], n_packets), dtype=complex)
+    select_subcarriers = c['select_subcarriers']
+    chunk_stats = {'packets': n_packets, 'coarse_searches': 0, 'blocks': []}
+    profiler = HotPathProfiler() if c['hot_path'] else hot_path_disabled
+
+    if c['solver'] == 'osqp':
+        # OSQP workspaces: one for the first step, one for each refined window of the second step (at most one for
+        # each point of the coarse grid), so that the KKT system is factorized only once for each window; the
+        # subcarrier selection is the same for the whole chunk
+        osqp_settings = solver_profiles[c['profile']]['osqp']
+        lasso_workspace = LassoOSQPWorkspace(c['T_matrix'], select_subcarriers, profiler=profiler, **osqp_settings)
+        lasso_workspaces_refined = {}
+
+        def solve_refined(signal_time_, t_window_):
+            time_start = profiler.clock()
+            T_matrix_refined, time_matrix_refined = build_T_matrix_cached(c['frequency_vector'],
+                                                                          c['delta_t_refined'], t_window_[0],
+                                                                          t_window_[1])
+            profiler.add_time('t_matrix', time_start)
+            if t_window_ not in lasso_workspaces_refined:
+                lasso_workspaces_refined[t_window_] = LassoOSQPWorkspace(T_matrix_refined, select_subcarriers,
+                                                                         profiler=profiler, **osqp_settings)
+            r_refined = lasso_workspaces_refined[t_window_].solve(signal_time_)
+            residual = None
+            if c['tracking']:
+                signal_selected = signal_time_[select_subcarriers]
+                residual = np.linalg.norm(T_matrix_refined[select_subcarriers, :] @ r_refined - signal_selected) / \
+                    np.linalg.norm(signal_selected)
+            return r_refined, residual
+
+        # tracking: the refined window of the previous packet is kept, without the coarse search, until the refined
+        # peak reaches the edge of the window or the residual jumps
+        t_window = None
+        residual_prev = None
+        packets_refined = {}
+        for time_step in range(n_packets):
+            profiler.start_row(time_step)
+            signal_time = signal_considered[:, time_step]
+
+            coarse_search = not c['tracking'] or t_window is None
+            if not coarse_search:
+                complex_opt_r_refined, residual = solve_refined(signal_time, t_window)
+                position_max_r_refined = np.argmax(abs(complex_opt_r_refined))
+                if position_max_r_refined in (0, complex_opt_r_refined.shape[0] - 1) or \
+                        residual > c['tracking_residual_jump'] * residual_prev:
+                    coarse_search = True
+
+            if coarse_search:
+                chunk_stats['coarse_searches'] += 1
+                complex_opt_r = lasso_workspace.solve(signal_time)
+
+                position_max_r = np.argmax(abs(complex_opt_r))
+                t_window_coarse = refined_window(c['time_matrix'][position_max_r], c['range_refined_down'],
+                                                 c['range_refined_up'], c['t_min'], c['t_max'])
+                if t_window_coarse != t_window or not c['tracking']:
+                    t_window = t_window_coarse
+                    complex_opt_r_refined, residual = solve_refined(signal_time, t_window)
+            residual_prev = residual
+
+            packets_refined.setdefault(t_window, []).append((time_step, complex_opt_r_refined))
+            profiler.end_row()
+
+        # Tr of the packets that share the refined window computed together
+        for t_window, packets_window in packets_refined.items():
+            time_start = profiler.clock()
+            time_steps = np.asarray([time_step for time_step, _ in packets_window])
+            complex_opt_r_refined_block = np.stack([r_refined for _, r_refined in packets_window], axis=1)
+            Tr_matrix[:, time_steps], start_r_opt = reconstruct_Tr(complex_opt_r_refined_block,
+                                                                         c['frequency_vector_complete'],
+                                                                         c['delta_t_refined'], t_window, c['t_min'],
+                                                                         c['operator'])
+            end_r_opt = start_r_opt + complex_opt_r_refined_block.shape[0]
+            r_optim[start_r_opt:end_r_opt, time_steps] = complex_opt_r_refined_block
+            profiler.spread_time('reconstruction', time_start, time_steps)
+        if c['hot_path']:
+            chunk_stats['hot_path'] = profiler.arrays()
+        return r_optim, Tr_matrix, chunk_stats
+
+    # batched solvers: one for the first step, one for each refined window of the second step
+    frequency_vector_selected = c['frequency_vector'][select_subcarriers]
+    batch_settings = solver_profiles[c['profile']]['batch']
+    lasso_solver = None
+    lasso_solvers_refined = {}
+
+    def solve_block(lasso_solver_, signal_block_):
+        time_start = profiler.clock()
+        complex_opt_r_block_, stats_ = lasso_solver_.solve(signal_block_)
+        profiler.add_time('solve', time_start)
+        profiler.add_solve(stats_['iterations'], stats_['packets'] - stats_['converged'], 0)
+        return complex_opt_r_block_, stats_
+
+    # one row of the hot path log for each block
+    for block_start in range(0, n_packets, c['block_size']):
+        block_end = min(block_start + c['block_size'], n_packets)
+        profiler.start_row(block_start, block_end - block_start)
+        if lasso_solver is None:
+            time_start = profiler.clock()
+            if c['operator'] == 'fft':
+                lasso_solver = LassoBatchSolver(DelayOperator(frequency_vector_selected, c['delta_t'], c['t_min'],
+                                                              c['t_max']), method=c['solver'], **batch_settings)
+            else:
+                lasso_solver = LassoBatchSolver(c['T_matrix'][select_subcarriers, :], method=c['solver'],
+                                                **batch_settings)
+            profiler.add_time('setup', time_start)
+        signal_block = signal_considered[select_subcarriers, block_start:block_end]
+        complex_opt_r_block, stats = solve_block(lasso_solver, signal_block)
+
+        # packets with the same coarse peak share the refined window and are solved together
+        positions_max_r = np.argmax(abs(complex_opt_r_block), axis=0)
+        stats_refined = []
+        for position_max_r in np.unique(positions_max_r):
+            packets_window = np.flatnonzero(positions_max_r == position_max_r)
+            t_window = refined_window(c['time_matrix'][position_max_r], c['range_refined_down'],
+                                      c['range_refined_up'], c['t_min'], c['t_max'])
+            if t_window not in lasso_solvers_refined:
+                time_start = profiler.clock()
+                if c['operator'] == 'fft':
+                    T_matrix_refined = DelayOperator(frequency_vector_selected, c['delta_t_refined'], t_window[0],
+                                                     t_window[1])
+                else:
+                    T_matrix_refined, time_matrix_refined = build_T_matrix_cached(c['frequency_vector'],
+                                                                                  c['delta_t_refined'],
+                                                                                  t_window[0], t_window[1])
+                    T_matrix_refined = T_matrix_refined[select_subcarriers, :]
+                profiler.add_time('t_matrix', time_start)
+                time_start = profiler.clock()
+                lasso_solvers_refined[t_window] = LassoBatchSolver(T_matrix_refined, method=c['solver'],
+                                                                   **batch_settings)
+                profiler.add_time('setup', time_start)
+            complex_opt_r_refined_block, stats_window = solve_block(lasso_solvers_refined[t_window],
+                                                                    signal_block[:, packets_window])
+            stats_refined.append(stats_window)
+
+            time_start = profiler.clock()
+            time_steps = block_start + packets_window
+            Tr_matrix[:, time_steps], start_r_opt = reconstruct_Tr(complex_opt_r_refined_block,
+                                                                         c['frequency_vector_complete'],
+                                                                         c['delta_t_refined'], t_window, c['t_min'],
+                                                                         c['operator'])
+            end_r_opt = start_r_opt + complex_opt_r_refined_block.shape[0]
+            r_optim[start_r_opt:end_r_opt, time_steps] = complex_opt_r_refined_block
+            profiler.add_time('reconstruction', time_start)
+
+        chunk_stats['coarse_searches'] += block_end - block_start
+        chunk_stats['blocks'].append((block_start, block_end, stats, merge_lasso_stats(stats_refined)))
+        profiler.end_row()
+    if c['hot_path']:
+        chunk_stats['hot_path'] = profiler.arrays()
+    return r_optim, Tr_matrix, chunk_stats
+
+
+def build_config(solver='osqp', block_size=1000, operator='dense', tracking=False, tracking_residual_jump=1.5,
+                 sub_sampling=1, profile='balanced', hot_path=False, n_subchannels=1024):
+    plan = band_plan(n_subchannels)
+    subcarriers_space = 2
+    delta_t = 1E-7
+    delta_t_refined = 5E-9
+    range_refined_up = 2.5E-7
+    range_refined_down = 2E-7
+
+    delta_f = 78.125E3
+    frequency_vector_complete = delta_f * plan.tones
+    frequency_vector = frequency_vector_complete[plan.data_idxs]
+
+    t_min = -3E-7
+    t_max = 5E-7
+
+    T_matrix, time_matrix = build_T_matrix(frequency_vector, delta_t, t_min, t_max)
+    r_length = int((t_max - t_min) / delta_t_refined)
+
+    start_subcarrier = 0
+    end_subcarrier = frequency_vector.shape[0]
+    select_subcarriers = np.arange(start_subcarrier, end_subcarrier, subcarriers_space)
+
+    config = {'frequency_vector': frequency_vector, 'frequency_vector_complete': frequency_vector_complete,
+              'select_subcarriers': select_subcarriers, 'T_matrix': T_matrix, 'time_matrix': time_matrix,
+              'delta_f': delta_f, 'delta_t': delta_t, 'delta_t_refined': delta_t_refined,
+              'range_refined_down': range_refined_down, 'range_refined_up': range_refined_up, 't_min': t_min,
+              't_max': t_max, 'r_length': r_length, 'solver': solver, 'block_size': block_size, 'operator': operator,
+              'tracking': tracking, 'tracking_residual_jump': tracking_residual_jump, 'sub_sampling': sub_sampling,
+              'profile': profile, 'hot_path': hot_path, 'Tr_stored_rows': plan.trim}
+    return config
+
+
+worker_data = {}
+
+
+def init_worker(shm_name, signal_shape, signal_dtype, config):
+    # signal_complete is read from the shared memory block created by the main process, not pickled to the workers
+    shm = shared_memory.SharedMemory(name=shm_name)
+    worker_data['shm'] = shm
+    worker_data['signal_complete'] = np.ndarray(signal_shape, dtype=signal_dtype, buffer=shm.buf)
+    worker_data['config'] = config
+
+
+def estimate_chunk_worker(task):
+    stream, chunk_start, chunk_end = task
+    sub_sampling = worker_data['config']['sub_sampling']
+    signal_considered = worker_data['signal_complete'][:, chunk_start:chunk_end:sub_sampling, stream]
+    return estimate_chunk(signal_considered, worker_data['config'])
+
+
+def print_chunk_stats(stream, offset, chunk_stats, tracking):
+    for block_start, block_end, stats, stats_refined in chunk_stats['blocks']:
+        print('stream %d, packets %d-%d: coarse %d iterations, %d/%d converged; refined %d iterations, '
+              '%d/%d converged' % (stream, offset + block_start, offset + block_end,
+                                   stats['iterations'], stats['converged'], stats['packets'],
+                                   stats_refined['iterations'], stats_refined['converged'],
+                                   stats_refined['packets']))
+    if tracking:
+        print('stream %d, packets %d-%d: %d coarse searches' % (stream, offset, offset + chunk_stats['packets'],
+                                                                chunk_stats['coarse_searches']))
+
+
+def pickle_atomic(name_file, data):
+    # the file is replaced only once completely written, a crash leaves either the old or the new version
+    name_file_tmp = name_file + '.tmp'
+    with open(name_file_tmp, "wb") as fp:  # Pickling
+        pickle.dump(data, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(name_file_tmp, name_file)
+
+
+def stream_processed(name, stream):
+    name_file_r = './phase_processing/r_vector_' + name + '_stream_' + str(stream) + '.txt'
+    name_file_compact = './phase_processing/H_estimation_' + name + '_stream_' + str(stream) + '.npz'
+    return path.exists(name_file_r) or path.exists(name_file_compact)
+
+
+def save_stream(name, stream, r_optim, Tr_matrix, storage, header, Tr_stored_rows):
+    if storage == 'compact':
+        name_file_compact = './phase_processing/H_estimation_' + name + '_stream_' + str(stream) + '.npz'
+        save_compact_stream(name_file_compact, r_optim, Tr_matrix, header, Tr_stored_rows.start, Tr_stored_rows.stop)
+        return
+
+    # Tr first: an existing r_vector file marks a completed stream
+    name_file_Tr = './phase_processing/Tr_vector_' + name + '_stream_' + str(stream) + '.txt'
+    pickle_atomic(name_file_Tr, Tr_matrix)
+
+    name_file_r = './phase_processing/r_vector_' + name + '_stream_' + str(stream) + '.txt'
+    pickle_atomic(name_file_r, r_optim)
+
+
+def load_checkpoint(name_file_checkpoint, checkpoint_key):
+    if not path.exists(name_file_checkpoint):
+        return None
+    with open(name_file_checkpoint, "rb") as fp:  # Unpickling
+        checkpoint = pickle.load(fp)
+    if checkpoint['key'] != checkpoint_key:
+        print('Checkpoint ' + name_file_checkpoint + ' from a different configuration, ignored')
+        return None
+    return checkpoint
+
+
+def iterate_chunk_results(signal_complete, tasks, config, workers):
+    if workers <= 1:
+        for stream, chunk_start, chunk_end in tasks:
+            yield estimate_chunk(signal_complete[:, chunk_start:chunk_end:config['sub_sampling'], stream], config)
+        return
+
+    shm = shared_memory.SharedMemory(create=True, size=signal_complete.nbytes)
+    try:
+        signal_shared = np.ndarray(signal_complete.shape, dtype=signal_complete.dtype, buffer=shm.buf)
+        signal_shared[...] = signal_complete
+        with multiprocessing.Pool(workers, initializer=init_worker,
+                                  initargs=(shm.name, signal_complete.shape, signal_complete.dtype,
+                                            config)) as pool:
+            # results come back in task order
+            for result in pool.imap(estimate_chunk_worker, tasks):
+                yield result
+        del signal_shared
+    finally:
+        shm.close()
+        shm.unlink()
 
 
 if __name__ == '__main__':
@@ -30,7 +358,46 @@ if __name__ == '__main__':
     parser.add_argument('ncore', help='Number of cores', type=int)
     parser.add_argument('start_r', help='Start processing', type=int)
     parser.add_argument('end_r', help='End processing', type=int)
+    parser.add_argument('--solver', help='LASSO solver, osqp (one QP per packet, reference), admm or fista (batched '
+                                         'over blocks of packets) (default osqp)', default='osqp', required=False,
+                        choices=['osqp', 'admm', 'fista'])
+    parser.add_argument('--profile', help='Solver profile, fast, balanced or reference: tolerances, maximum number of '
+                                          'iterations, polishing and adaptive rho of the solvers (default balanced)',
+                        default='balanced', required=False, choices=list(solver_profiles.keys()))
+    parser.add_argument('--block_size', help='Number of packets solved together by the batched solvers '
+                                             '(default 1000)', default=1000, required=False, type=int)
+    parser.add_argument('--operator', help='Delay-domain dictionary used by the batched solvers and the Tr '
+                                           'reconstruction, dense (T matrix) or fft (chirp-z transforms, for fine '
+                                           'delay grids) (default dense)', default='dense', required=False,
+                        choices=['dense', 'fft'])
+    parser.add_argument('--tracking', help='Skip the coarse delay search while the peak stays inside the refined '
+                                           'window of the previous packet, only with the osqp solver',
+                        action='store_true', required=False)
+    parser.add_argument('--tracking_residual_jump', help='Relative increase of the residual, with respect to the '
+                                                         'previous packet, that triggers a new coarse search in '
+                                                         'tracking mode (default 1.5)', default=1.5, required=False,
+                        type=float)
+    parser.add_argument('--sub_sampling', help='Estimate only one packet every sub_sampling packets, the Doppler '
+                                               'computation is then run with --presampled (default 1)', default=1,
+                        required=False, type=int)
+    parser.add_argument('--workers', help='Number of processes, each stream is split in chunks of packets processed '
+                                          'in parallel (default 1)', default=1, required=False, type=int)
+    parser.add_argument('--chunk_size', help='Number of packets in a chunk (default 1000)', default=1000,
+                        required=False, type=int)
+    parser.add_argument('--storage', help='Output format, compact (one .npz file per stream with the windows of r and '
+                                          'the data subcarriers of Tr in complex64) or pickle (dense r_vector and '
+                                          'Tr_vector files) (default compact)', default='compact', required=False,
+                        choices=['compact', 'pickle'])
+    parser.add_argument('--hot_path_log', help='Record the time spent by each packet in T matrix construction, '
+                                               'assembly, solver setup, solve and Tr reconstruction with the solver '
+                                               'statistics (./phase_processing/hot_path_<name>_stream_<k>.npz) and '
+                                               'print a summary for each stream', action='store_true', required=False)
+    parser.add_argument('--checkpoint_interval', help='Minimum time in [s] between two checkpoints of the partial '
+                                                      'results of a stream (default 300)', default=300,
+                        required=False, type=float)
     args = parser.parse_args()
+    if args.tracking and args.solver != 'osqp':
+        parser.error('--tracking is only available with the osqp solver')
 
     exp_save_dir = args.dir
     names = []
@@ -49,133 +416,94 @@ if __name__ == '__main__':
     n_tot = n_ss * n_core
 
     for name in names:
-        name_file_r = './phase_processing/r_vector_' + name + '_stream_' + str(n_tot - 1) + '.txt'
-        if path.exists(name_file_r):
+        if stream_processed(name, n_tot - 1):
             print('Already processed')
             continue
 
-        name_file = './phase_processing/signal_' + name + '.txt'
-        with open(name_file, "rb") as fp:  # Pickling
-            signal_complete = pickle.load(fp)
-
-        delete_idxs = np.asarray([-512, -511, -510, -509, -508, -507, -506, -505, -504, -503, -502, -501,
-                                  -2, -1, 0, 1, 2,
-                                  501, 502, 503, 504, 505, 506, 507, 508, 509, 510, 511], dtype=int) + 512
-        # pilot_subcarriers = np.asarray([-468, -400, -334, -266, -158, -92, -24, 24, 92, 158, 226, 334, 400, 468]) + 512
-        subcarriers_space = 2
-        delta_t = 1E-7
-        delta_t_refined = 5E-9
-        range_refined_up = 2.5E-7
-        range_refined_down = 2E-7
-
+        # only the packets start_r:end_r are read, signal_complete[:, 0] is packet start_r
         start_r = args.start_r
         if args.end_r != -1:
             end_r = args.end_r
+            signal_complete = load_signal(name, slice(start_r, end_r))
         else:
-            end_r = signal_complete.shape[1]
-
-        F_frequency = 1024
-        delta_f = 78.125E3
-        frequency_vector_complete = np.zeros(F_frequency, )
-        F_frequency_2 = F_frequency // 2
-        for row in range(F_frequency_2):
-            freq_n = delta_f * (row - F_frequency / 2)
-            frequency_vector_complete[row] = freq_n
-            freq_p = delta_f * row
-            frequency_vector_complete[row + F_frequency_2] = freq_p
-        frequency_vector = np.delete(frequency_vector_complete, delete_idxs)
-
-        T = 1/delta_f
-        t_min = -3E-7
-        t_max = 5E-7
-
-        T_matrix, time_matrix = build_T_matrix(frequency_vector, delta_t, t_min, t_max)
-        r_length = int((t_max - t_min) / delta_t_refined)
-
-        start_subcarrier = 0
-        end_subcarrier = frequency_vector.shape[0]
-        select_subcarriers = np.arange(start_subcarrier, end_subcarrier, subcarriers_space)
-
-        # Auxiliary data for first step
-        row_T = int(T_matrix.shape[0] / subcarriers_space)
-        col_T = T_matrix.shape[1]
-        m = 2 * row_T
-        n = 2 * col_T
-        In = scipy.sparse.eye(n)
-        Im = scipy.sparse.eye(m)
-        On = scipy.sparse.csc_matrix((n, n))
-        Onm = scipy.sparse.csc_matrix((n, m))
-        P = scipy.sparse.block_diag([On, Im, On], format='csc')
-        q = np.zeros(2 * n + m)
-        A2 = scipy.sparse.hstack([In, Onm, -In])
-        A3 = scipy.sparse.hstack([In, Onm, In])
-        ones_n_matr = np.ones(n)
-        zeros_n_matr = np.zeros(n)
-        zeros_nm_matr = np.zeros(n + m)
-
-        for stream in range(0, 4):
-            name_file = './phase_processing/r_vector' + name + '_stream_' + str(stream) + '.txt'
-            signal_considered = signal_complete[:, start_r:end_r, stream]
-            r_optim = np.zeros((r_length, end_r - start_r), dtype=complex)
-            Tr_matrix = np.zeros((frequency_vector_complete.shape[0], end_r - start_r), dtype=complex)
-
-            for time_step in range(end_r - start_r):
-                signal_time = signal_considered[:, time_step]
-                complex_opt_r = lasso_regression_osqp_fast(signal_time, T_matrix, select_subcarriers, row_T, col_T,
-                                                           Im, Onm, P, q, A2, A3, ones_n_matr, zeros_n_matr,
-                                                           zeros_nm_matr)
-
-                position_max_r = np.argmax(abs(complex_opt_r))
-                time_max_r = time_matrix[position_max_r]
-
-                T_matrix_refined, time_matrix_refined = build_T_matrix(frequency_vector, delta_t_refined,
-                                                                       max(time_max_r - range_refined_down, t_min),
-                                                                       min(time_max_r + range_refined_up, t_max))
-
-                # Auxiliary data for second step
-                col_T_refined = T_matrix_refined.shape[1]
-                n_refined = 2 * col_T_refined
-                In_refined = scipy.sparse.eye(n_refined)
-                On_refined = scipy.sparse.csc_matrix((n_refined, n_refined))
-                Onm_refined = scipy.sparse.csc_matrix((n_refined, m))
-                P_refined = scipy.sparse.block_diag([On_refined, Im, On_refined], format='csc')
-                q_refined = np.zeros(2 * n_refined + m)
-                A2_refined = scipy.sparse.hstack([In_refined, Onm_refined, -In_refined])
-                A3_refined = scipy.sparse.hstack([In_refined, Onm_refined, In_refined])
-                ones_n_matr_refined = np.ones(n_refined)
-                zeros_n_matr_refined = np.zeros(n_refined)
-                zeros_nm_matr_refined = np.zeros(n_refined + m)
-
-                complex_opt_r_refined = lasso_regression_osqp_fast(signal_time, T_matrix_refined, select_subcarriers,
-                                                                   row_T, col_T_refined, Im, Onm_refined, P_refined,
-                                                                   q_refined, A2_refined, A3_refined,
-                                                                   ones_n_matr_refined, zeros_n_matr_refined,
-                                                                   zeros_nm_matr_refined)
-
-                position_max_r_refined = np.argmax(abs(complex_opt_r_refined))
-
-                T_matrix_refined, time_matrix_refined = build_T_matrix(frequency_vector_complete, delta_t_refined,
-                                                                       max(time_max_r - range_refined_down, t_min),
-                                                                       min(time_max_r + range_refined_up, t_max))
+            signal_complete = load_signal(name, slice(start_r, None))
+            end_r = start_r + signal_complete.shape[1]
 
-                Tr = np.multiply(T_matrix_refined, complex_opt_r_refined)
+        sub_sampling = args.sub_sampling
+        n_packets = len(range(start_r, end_r, sub_sampling))
+        config = build_config(solver=args.solver, block_size=args.block_size, operator=args.operator,
+                              tracking=args.tracking, tracking_residual_jump=args.tracking_residual_jump,
+                              sub_sampling=sub_sampling, profile=args.profile, hot_path=args.hot_path_log,
+                              n_subchannels=band_plan_of(signal_complete.shape[0]).n_subcarriers)
+        r_length = config['r_length']
+        frequency_vector_complete = config['frequency_vector_complete']
 
-                Tr_sum = np.sum(Tr, axis=1)
+        # grids of the compact output
+        header = {'name': name, 'start_r': start_r, 'end_r': end_r, 'sub_sampling': sub_sampling,
+                  'delta_f': config['delta_f'], 't_min': config['t_min'], 't_max': config['t_max'],
+                  'delta_t_refined': config['delta_t_refined'], 'solver': args.solver, 'profile': args.profile}
 
-                Trr = np.multiply(Tr, np.conj(Tr[:, position_max_r_refined:position_max_r_refined + 1]))
-                Trr_sum = np.sum(Trr, axis=1)
+        # chunks of packets chunk_start:chunk_end:sub_sampling
+        chunks = [(chunk_start, min(chunk_start + args.chunk_size * sub_sampling, end_r))
+                  for chunk_start in range(start_r, end_r, args.chunk_size * sub_sampling)]
 
-                Tr_matrix[:, time_step] = Trr_sum
-                time_max_r = time_matrix_refined[position_max_r_refined]
+        # checkpoints are valid only for the same packet range and solver configuration
+        checkpoint_key = (start_r, end_r, args.chunk_size, args.solver, args.block_size, args.operator,
+                          args.tracking, args.tracking_residual_jump, sub_sampling, args.profile)
+        tasks = []
+        checkpoints = {}
+        for stream in range(n_tot):
+            if stream_processed(name, stream):
+                continue
+            name_file_checkpoint = './phase_processing/checkpoint_' + name + '_stream_' + str(stream) + '.txt'
+            checkpoints[stream] = load_checkpoint(name_file_checkpoint, checkpoint_key)
+            last_packet = start_r - 1
+            if checkpoints[stream] is not None:
+                last_packet = checkpoints[stream]['last_packet']
+                print('Stream ' + str(stream) + ' resumed after packet ' + str(last_packet))
+            tasks.extend([(stream, chunk_start, chunk_end) for chunk_start, chunk_end in chunks
+                          if chunk_start > last_packet])
 
-                start_r_opt = int((time_matrix_refined[0] - t_min)/delta_t_refined)
-                end_r_opt = start_r_opt + complex_opt_r_refined.shape[0]
-                r_optim[start_r_opt:end_r_opt, time_step] = complex_opt_r_refined
+        stream_act = None
+        time_checkpoint = time.time()
+        signal_tasks = [(stream, chunk_start - start_r, chunk_end - start_r)
+                        for stream, chunk_start, chunk_end in tasks]
+        results = iterate_chunk_results(signal_complete, signal_tasks, config, args.workers)
+        for task_idx, result in enumerate(results):
+            stream, chunk_start, chunk_end = tasks[task_idx]
+            name_file_checkpoint = './phase_processing/checkpoint_' + name + '_stream_' + str(stream) + '.txt'
+            if stream != stream_act:
+                stream_act = stream
+                if checkpoints[stream] is not None:
+                    r_optim = checkpoints[stream]['r_optim']
+                    Tr_matrix = checkpoints[stream]['Tr_matrix']
+                    checkpoints[stream] = None
+                else:
+                    r_optim = np.zeros((r_length, n_packets), dtype=complex)
+                    Tr_matrix = np.zeros((frequency_vector_complete.shape[0], n_packets), dtype=complex)
+                hot_path_list = []
 
-            name_file_r = './phase_processing/r_vector_' + name + '_stream_' + str(stream) + '.txt'
-            with open(name_file_r, "wb") as fp:  # Pickling
-                pickle.dump(r_optim, fp)
+            r_optim_chunk, Tr_matrix_chunk, chunk_stats = result
+            column_start = (chunk_start - start_r) // sub_sampling
+            column_end = column_start + r_optim_chunk.shape[1]
+            r_optim[:, column_start:column_end] = r_optim_chunk
+            Tr_matrix[:, column_start:column_end] = Tr_matrix_chunk
+            print_chunk_stats(stream, column_start, chunk_stats, args.tracking)
+            if args.hot_path_log:
+                chunk_stats['hot_path']['packet'] += column_start
+                hot_path_list.append(chunk_stats['hot_path'])
 
-            name_file_Tr = './phase_processing/Tr_vector_' + name + '_stream_' + str(stream) + '.txt'
-            with open(name_file_Tr, "wb") as fp:  # Pickling
-                pickle.dump(Tr_matrix, fp)
+            if chunk_end == end_r:
+                save_stream(name, stream, r_optim, Tr_matrix, args.storage, header, config['Tr_stored_rows'])
+                if args.hot_path_log:
+                    # only the chunks processed by this run when resumed from a checkpoint
+                    hot_path = concatenate_hot_path(hot_path_list)
+                    np.savez('./phase_processing/hot_path_' + name + '_stream_' + str(stream) + '.npz', **hot_path)
+                    print('stream %d hot path' % stream)
+                    print(hot_path_summary(hot_path))
+                if path.exists(name_file_checkpoint):
+                    os.remove(name_file_checkpoint)
+            elif time.time() - time_checkpoint > args.checkpoint_interval:
+                pickle_atomic(name_file_checkpoint, {'key': checkpoint_key, 'last_packet': chunk_end - sub_sampling,
+                                                     'r_optim': r_optim, 'Tr_matrix': Tr_matrix})
+                time_checkpoint = time.time()
@@ -0,0 +1,94 @@
+
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import numpy as np
+import time
+from CSI_phase_sanitization_H_estimation import build_config, estimate_chunk
+from CSI_phase_sanitization_signal_reconstruction import sanitize_phase
+from optimization_utility import solver_profiles
+from storage_utility import load_signal
+from band_utility import band_plan_of
+
+
+def sanitized_phases(Tr_matrices, Tr_stored_rows):
+    phases = []
+    for Tr_matrix in Tr_matrices:
+        phases.append(sanitize_phase(Tr_matrix[Tr_stored_rows, :]))
+    return phases
+
+
+def phase_deviation_from(phases, phases_reference):
+    # the sanitized phase is anchored to the first packet: an offset of a subcarrier that is the same for all the
+    # packets does not change the Doppler spectrum and is removed before the comparison
+    phase_deviation = []
+    for phase, phase_reference in zip(phases, phases_reference):
+        phase_error = np.exp(1j * (phase - phase_reference))
+        phase_error = phase_error * np.conj(np.exp(1j * np.angle(np.mean(phase_error, axis=1, keepdims=True))))
+        phase_deviation.append(np.abs(np.angle(phase_error)).ravel())
+    return np.concatenate(phase_deviation)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('name', help='Name of experiment file (./phase_processing/signal_<name>.npy or .txt)')
+    parser.add_argument('nss', help='Number of spatial streams', type=int)
+    parser.add_argument('ncore', help='Number of cores', type=int)
+    parser.add_argument('start_r', help='Start processing', type=int)
+    parser.add_argument('end_r', help='End processing', type=int)
+    parser.add_argument('--solver', help='LASSO solver, osqp, admm or fista (default osqp)', default='osqp',
+                        required=False, choices=['osqp', 'admm', 'fista'])
+    parser.add_argument('--block_size', help='Number of packets solved together by the batched solvers '
+                                             '(default 1000)', default=1000, required=False, type=int)
+    parser.add_argument('--operator', help='Delay-domain dictionary, dense or fft (default dense)', default='dense',
+                        required=False, choices=['dense', 'fft'])
+    parser.add_argument('--profiles', help='Comma separated solver profiles compared with the reference one '
+                                           '(default fast,balanced)', default='fast,balanced', required=False)
+    args = parser.parse_args()
+
+    profiles = ['reference'] + [profile for profile in args.profiles.split(',') if profile != 'reference']
+    for profile in profiles:
+        if profile not in solver_profiles:
+            parser.error('Unknown solver profile ' + profile)
+
+    # only the packets start_r:end_r are read, once for all the profiles
+    end_r = args.end_r if args.end_r != -1 else None
+    signal_considered = np.array(load_signal(args.name, slice(args.start_r, end_r)))
+    n_tot = args.nss * args.ncore
+    n_packets = signal_considered.shape[1] * n_tot
+
+    print('%-10s %12s %22s %22s %22s' % ('profile', 'packets/s', 'mean |dphase| [rad]', 'p99 |dphase| [rad]',
+                                        'max |dphase| [rad]'))
+    phases_reference = None
+    for profile in profiles:
+        config = build_config(solver=args.solver, block_size=args.block_size, operator=args.operator,
+                              profile=profile, n_subchannels=band_plan_of(signal_considered.shape[0]).n_subcarriers)
+        # warm up of the T matrix caches, not timed
+        estimate_chunk(signal_considered[:, :1, 0], config)
+
+        time_start = time.time()
+        Tr_matrices = []
+        for stream in range(n_tot):
+            r_optim, Tr_matrix, chunk_stats = estimate_chunk(signal_considered[:, :, stream], config)
+            Tr_matrices.append(Tr_matrix)
+        packets_per_second = n_packets / (time.time() - time_start)
+
+        phases = sanitized_phases(Tr_matrices, config['Tr_stored_rows'])
+        if phases_reference is None:
+            phases_reference = phases
+        phase_deviation = phase_deviation_from(phases, phases_reference)
+        print('%-10s %12.1f %22.2e %22.2e %22.2e' % (profile, packets_per_second, np.mean(phase_deviation),
+                                                     np.percentile(phase_deviation, 99), np.max(phase_deviation)))
@@ -0,0 +1,80 @@
+
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import numpy as np
+import time
+import warnings
+from CSI_phase_sanitization_signal_preprocessing import hampel_filter
+from storage_utility import load_signal
+
+
+def hampel_filter_loop(input_matrix, window_size, n_sigmas=3):
+    # previous implementation, one window per column
+    n = input_matrix.shape[1]
+    new_matrix = np.zeros_like(input_matrix)
+    k = 1.4826  # scale factor for Gaussian distribution
+
+    for ti in range(n):
+        start_time = max(0, ti - window_size)
+        end_time = min(n, ti + window_size)
+        x0 = np.nanmedian(input_matrix[:, start_time:end_time], axis=1, keepdims=True)
+        s0 = k * np.nanmedian(np.abs(input_matrix[:, start_time:end_time] - x0), axis=1)
+        mask = (np.abs(input_matrix[:, ti] - x0[:, 0]) > n_sigmas * s0)
+        new_matrix[:, ti] = mask*x0[:, 0] + (1 - mask)*input_matrix[:, ti]
+
+    return new_matrix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('window_size', help='Half length of the window of the hampel filter', type=int)
+    parser.add_argument('--name', help='Name of experiment file (./phase_processing/signal_<name>.npy or .txt) '
+                                       'whose amplitude is filtered, synthetic data if not given', default=None,
+                        required=False)
+    parser.add_argument('--n_subcarriers', help='Number of subcarriers (rows) of the synthetic data (default 996)',
+                        default=996, required=False, type=int)
+    parser.add_argument('--n_packets', help='Number of packets (columns) filtered (default 2000)', default=2000,
+                        required=False, type=int)
+    parser.add_argument('--n_sigmas', help='Threshold in number of standard deviations (default 3)', default=3,
+                        required=False, type=float)
+    args = parser.parse_args()
+
+    if args.name is not None:
+        amplitude = np.abs(np.array(load_signal(args.name, slice(0, args.n_packets))[:, :, 0]))
+    else:
+        # amplitude with 1% of outliers and 0.1% of missing values
+        rng = np.random.default_rng(0)
+        amplitude = 1 + 0.1 * rng.standard_normal((args.n_subcarriers, args.n_packets))
+        amplitude[rng.random(amplitude.shape) < 0.01] *= 10
+        amplitude[rng.random(amplitude.shape) < 0.001] = np.nan
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # all-NaN windows
+        time_start = time.time()
+        filtered_loop = hampel_filter_loop(amplitude, args.window_size, args.n_sigmas)
+        time_loop = time.time() - time_start
+
+        time_start = time.time()
+        filtered = hampel_filter(amplitude, args.window_size, args.n_sigmas)
+        time_vectorized = time.time() - time_start
+
+    print('%d subcarriers, %d packets, window %d' % (amplitude.shape[0], amplitude.shape[1], args.window_size))
+    print('%-12s %12s %12s' % ('', 'time [s]', 'packets/s'))
+    print('%-12s %12.3f %12.1f' % ('loop', time_loop, amplitude.shape[1] / time_loop))
+    print('%-12s %12.3f %12.1f' % ('vectorized', time_vectorized, amplitude.shape[1] / time_vectorized))
+    print('same output: %s, %d outliers replaced' % (np.array_equal(filtered, filtered_loop, equal_nan=True),
+                                                      np.sum(filtered != amplitude) - np.sum(np.isnan(amplitude))))
@@ -16,28 +16,173 @@
 
 import argparse
 import numpy as np
-import scipy.io as sio
 from os import listdir
-import pickle
-from os import path
-
-
-def hampel_filter(input_matrix, window_size, n_sigmas=3):
+from mat_utility import iterate_cell
+from storage_utility import NpyAppender, signal_exists
+from band_utility import band_plan
+
+
+def nanmedian_sorted(windows_sorted):
+    # median along the last axis of windows sorted with the NaNs last, ignoring the NaNs (NaN if all the entries are
+    # NaN) as np.nanmedian
+    window_length = windows_sorted.shape[-1]
+    median = (windows_sorted[..., (window_length - 1) // 2] + windows_sorted[..., window_length // 2]) / 2
+
+    incomplete = np.isnan(windows_sorted[..., -1])
+    if np.any(incomplete):
+        windows_incomplete = windows_sorted[incomplete]
+        n_valid = np.sum(~np.isnan(windows_incomplete), axis=-1, keepdims=True)
+        low = np.take_along_axis(windows_incomplete, np.maximum((n_valid - 1) // 2, 0), axis=-1)[:, 0]
+        high = np.take_along_axis(windows_incomplete, n_valid // 2, axis=-1)[:, 0]
+        median[incomplete] = np.where(n_valid[:, 0] > 0, (low + high) / 2, np.nan)
+    return median
+
+
+def hampel_filter(input_matrix, window_size, n_sigmas=3, start=0, end=None, memory_mb=64):
+    # columns start:end of input_matrix (rows, time) with the outliers replaced by the median of the window
+    # [ti - window_size, ti + window_size) of the same row, NaNs ignored. The windows are sliding views of the
+    # NaN-padded matrix, sorted for blocks of columns at a time instead of one np.nanmedian per column; the blocks
+    # are as large as the copy of their windows (rows x columns x 2 window_size) fits in memory_mb MB
     n = input_matrix.shape[1]
-    new_matrix = np.zeros_like(input_matrix)
+    end = n if end is None else end
     k = 1.4826  # scale factor for Gaussian distribution
-
-    for ti in range(n):
-        start_time = max(0, ti - window_size)
-        end_time = min(n, ti + window_size)
-        x0 = np.nanmedian(input_matrix[:, start_time:end_time], axis=1, keepdims=True)
-        s0 = k * np.nanmedian(np.abs(input_matrix[:, start_time:end_time] - x0), axis=1)
-        mask = (np.abs(input_matrix[:, ti] - x0[:, 0]) > n_sigmas * s0)
-        new_matrix[:, ti] = mask*x0[:, 0] + (1 - mask)*input_matrix[:, ti]
+    column_bytes = input_matrix.shape[0] * 2 * window_size * np.dtype(float).itemsize
+    block_size = max(int(memory_mb * 2 ** 20 // column_bytes), 1)
+
+    padded = np.pad(input_matrix, ((0, 0), (window_size, window_size - 1)), constant_values=np.nan)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * window_size, axis=1)
+    new_matrix = np.array(input_matrix[:, start:end])
+    for block_start in range(start, end, block_size):
+        block_end = min(block_start + block_size, end)
+        # one copy of the windows of the block, sorted in place for the median and then for the MAD
+        windows_block = np.sort(windows[:, block_start:block_end], axis=-1)
+        x0 = nanmedian_sorted(windows_block)
+        windows_block -= x0[:, :, None]
+        np.abs(windows_block, out=windows_block)
+        windows_block.sort(axis=-1)
+        s0 = k * nanmedian_sorted(windows_block)
+        values = input_matrix[:, block_start:block_end]
+        mask = np.abs(values - x0) > n_sigmas * s0
+        new_matrix[:, block_start - start:block_end - start] = np.where(mask, x0, values)
 
     return new_matrix
 
 
+def hampel_filter_blocks(csi_blocks, window_size, n_sigmas=3, memory_mb=64):
+    # hampel_filter of the amplitude of the CSI along the packets for a sequence of blocks (packets, ...), the phase
+    # of the outliers is kept. The last packets of a block are filtered with the following block, once all the
+    # packets of their window are known
+    buffer = None  # packets from window_size before the first packet not yet filtered
+    n_done = 0  # packets of buffer already filtered
+    for csi_block in csi_blocks:
+        buffer = csi_block if buffer is None else np.concatenate((buffer, csi_block))
+        end = buffer.shape[0] - (window_size - 1)
+        if end > n_done:
+            yield hampel_filter_csi(buffer, window_size, n_sigmas, n_done, end, memory_mb)
+            keep_start = max(end - window_size, 0)
+            buffer = buffer[keep_start:]
+            n_done = end - keep_start
+    if buffer is not None and buffer.shape[0] > n_done:
+        yield hampel_filter_csi(buffer, window_size, n_sigmas, n_done, buffer.shape[0], memory_mb)
+
+
+def hampel_filter_csi(csi_buff, window_size, n_sigmas, start, end, memory_mb=64):
+    # packets start:end of csi_buff (packets, ...) with hampel_filter applied to the amplitude
+    amplitude = np.abs(csi_buff).reshape(csi_buff.shape[0], -1).T
+    amplitude_filtered = hampel_filter(amplitude, window_size, n_sigmas, start, end, memory_mb).T.reshape(
+        (end - start,) + csi_buff.shape[1:])
+    csi_block = csi_buff[start:end]
+    outliers = amplitude_filtered != np.abs(csi_block)
+    return np.where(outliers, amplitude_filtered * np.exp(1j * np.angle(csi_block)), csi_block)
+
+
+def cores_payloads(cores_chunk, ncore, nss):
+    # payloads of a chunk of packets of the AX-CSI cores struct: number of cores of each packet and of streams of each
+    # of these cores (up to ncore and nss) and the data of the streams in packet, core, stream order
+    cores_pkts = cores_chunk[0]
+    n_cores = np.array([min(cores_pkt.shape[1], ncore) if cores_pkt.shape[0] else 0 for cores_pkt in cores_pkts],
+                       dtype=int)
+    nss_cores = [cores_pkt[0, core_idx]['nss'][0][0] for cores_pkt, n_core in zip(cores_pkts, n_cores)
+                 for core_idx in range(n_core)]
+    n_streams = np.array([min(nss_core.shape[1], nss) if nss_core.shape[0] else 0 for nss_core in nss_cores],
+                         dtype=int)
+    payloads = [nss_core[0, ss_idx]['data'][0][0] for nss_core, n_stream in zip(nss_cores, n_streams)
+                for ss_idx in range(n_stream)]
+    return n_cores, n_streams, payloads
+
+
+def ragged_positions(counts):
+    # position of each entry within its group for groups of the given sizes laid out one after the other
+    return np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def extract_cores(cores_chunks, ncore, nsubchannels, nss=1):
+    # CSI of the AX-CSI cores struct, given in chunks of packets ((1, packets) cell arrays as in sio.loadmat), in
+    # packet-major blocks (packets, nss * ncore, subcarriers), stream ss of core core_idx in column
+    # ss * ncore + core_idx. Each entry is one contiguous copy; as in the original packet by packet loop the column
+    # advances only when the last entry of the packet is valid (otherwise the next packet overwrites the valid
+    # entries, also across chunks) and the last column is dropped. Missing cores or streams and empty payloads are
+    # invalid entries
+    n_streams = nss * ncore
+    csi_column = np.zeros((n_streams, nsubchannels), dtype=complex)  # column being filled
+    csi_last = None  # last completed column, yielded only if another one follows
+    for cores_chunk in cores_chunks:
+        npkt = cores_chunk.shape[1]
+        n_cores, n_streams_core, payloads = cores_payloads(cores_chunk, ncore, nss)
+        # packet, core and stream of each payload
+        core_pkt = np.repeat(np.arange(npkt), n_cores)
+        core_idxs = ragged_positions(n_cores)
+        payload_core = np.repeat(np.arange(n_cores.sum()), n_streams_core)
+        payload_pkt = core_pkt[payload_core]
+        payload_core_idx = core_idxs[payload_core]
+        payload_ss = ragged_positions(n_streams_core)
+        payload_length = np.array([payload.size for payload in payloads], dtype=int)
+        valid_payload = payload_length > 0
+        if np.any(payload_length[valid_payload] != nsubchannels):
+            raise ValueError('CSI payloads of %s subcarriers, expected %d'
+                             % (np.unique(payload_length[valid_payload]), nsubchannels))
+        valid = np.zeros((npkt, ncore, nss), dtype=bool)
+        valid[payload_pkt[valid_payload], payload_core_idx[valid_payload], payload_ss[valid_payload]] = True
+        inserted = valid[:, ncore - 1, nss - 1]
+
+        csi_buff = np.zeros((npkt + 2, n_streams, nsubchannels), dtype=complex)
+        matrix_idx = 0
+        if csi_last is not None:
+            csi_buff[0] = csi_last
+            matrix_idx = 1
+        csi_buff[matrix_idx] = csi_column
+        # row of each packet: the packets not inserted share the row with the next one, the last write wins
+        pkt_rows = matrix_idx + np.cumsum(inserted) - inserted
+        if np.any(valid_payload):
+            rows = pkt_rows[payload_pkt[valid_payload]]
+            columns = payload_ss[valid_payload] * ncore + payload_core_idx[valid_payload]
+            data = np.concatenate([payloads[idx].reshape(-1) for idx in np.flatnonzero(valid_payload)])
+            data = data.reshape(-1, nsubchannels)
+            # last occurrence of each (row, column), the order of repeated indices in an assignment is unspecified
+            _, last_reversed = np.unique((rows * n_streams + columns)[::-1], return_index=True)
+            last = rows.size - 1 - last_reversed
+            csi_buff[rows[last], columns[last]] = data[last]
+        matrix_idx += int(np.sum(inserted))
+        csi_column = csi_buff[matrix_idx].copy()
+        if matrix_idx > 0:
+            csi_last = csi_buff[matrix_idx - 1].copy()
+            yield csi_buff[:matrix_idx - 1]
+
+
+def signal_blocks(csi_blocks, plan, start):
+    # blocks of signal_complete (packets, streams, data subcarriers) from the blocks of extract_cores, without the
+    # empty packets and the first start packets
+    for csi_buff in csi_blocks:
+        packets_idxs = np.flatnonzero(np.sum(csi_buff, axis=(1, 2)) != 0)  # packets not empty
+
+        skip = min(start, packets_idxs.shape[0])
+        start -= skip
+        packets_idxs = packets_idxs[skip:]
+
+        # one gather for the packets, the fftshift and the removal of guard and DC subcarriers
+        yield csi_buff[np.ix_(packets_idxs, np.arange(csi_buff.shape[1]), plan.data_fft_idxs)]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('dir', help='Directory of data')
@@ -47,6 +192,17 @@ if __name__ == '__main__':
     parser.add_argument('ncore', help='Number of cores', type=int)
     parser.add_argument('nsubchannels', help='Number of subchannels', type=int)
     parser.add_argument('start_idx', help='Idx where start processing for each stream', type=int)
+    parser.add_argument('--chunk_size', help='Number of packets read from the .mat file and processed at a time, '
+                                             'bounds the memory (default 1000)', default=1000, required=False,
+                        type=int)
+    parser.add_argument('--hampel_window', help='Half length of the window of the hampel filter applied to the '
+                                                'amplitude of each subcarrier along the packets to replace the '
+                                                'outliers, 0 for no filter (default 0)', default=0, required=False,
+                        type=int)
+    parser.add_argument('--hampel_sigmas', help='Threshold of the hampel filter in number of standard deviations '
+                                                '(default 3)', default=3, required=False, type=float)
+    parser.add_argument('--hampel_memory', help='Memory for the windows of the hampel filter sorted at a time [MB] '
+                                                '(default 64)', default=64, required=False, type=float)
     args = parser.parse_args()
 
     exp_dir = args.dir
@@ -62,54 +218,32 @@ if __name__ == '__main__':
         names.append(args.name)
 
     for name in names:
-        name_file = './phase_processing/signal_' + name + '.txt'
-        if path.exists(name_file):
+        if signal_exists(name):
             print('Already processed')
             continue
 
         csi_buff_file = exp_dir + name + ".mat"
-        csi_buff_struct = sio.loadmat(csi_buff_file)
-        csi_buff_struct = (csi_buff_struct['cores'])
+        cores_chunks = iterate_cell(csi_buff_file, 'cores', args.chunk_size)
 
-        npkt = csi_buff_struct.shape[1]
         ncore = args.ncore
         nsubchannels = args.nsubchannels
 
-        csi_buff = np.zeros((nsubchannels, npkt, ncore), dtype=complex)
-
-        matrix_idx = 0
-        for pkt_idx in range(npkt):
-            for core_idx in range(ncore):
-                inserted = True
-                try:
-                    csi_buff[:, matrix_idx, core_idx] = csi_buff_struct[0][pkt_idx][0, core_idx]['nss'][0][0][0, 0]['data'][0][0]
-                except IndexError:
-                    inserted = False
-                    continue
-            if inserted:
-                matrix_idx += 1
-
-        csi_buff = csi_buff[:, :matrix_idx - 1, :]
-
-        csi_buff = np.fft.fftshift(csi_buff, axes=0)
-
-        delete_idxs = np.argwhere(np.sum(np.sum(csi_buff, axis=0), axis=1) == 0)[:, 0]  # packets empty
-        csi_buff = np.delete(csi_buff, delete_idxs, axis=1)
-
-        delete_idxs = np.asarray([-512, -511, -510, -509, -508, -507, -506, -505, -504, -503, -502, -501,
-                                  -2, -1, 0, 1, 2,
-                                  501, 502, 503, 504, 505, 506, 507, 508, 509, 510, 511], dtype=int) + 512
-        pilot_subcarriers = np.asarray([-468, -400, -334, -266, -158, -92, -24, 24, 92, 158, 226, 334, 400, 468]) + 512
-        csi_buff = np.delete(csi_buff, delete_idxs, axis=0)
+        # data and pilot subcarriers of the capture, gathered in fftshift order
+        plan = band_plan(nsubchannels)
 
         n_ss = args.nss
         n_core = args.ncore
         n_tot = n_ss * n_core
 
         start = args.start_idx  # 1000
-        end = csi_buff.shape[1]
-        signal_complete = csi_buff[:, start:end, :]
 
-        name_file = './phase_processing/signal_' + name + '.txt'
-        with open(name_file, "wb") as fp:  # Pickling
-            pickle.dump(signal_complete, fp)
+        # signal_complete written packet by packet (packets, streams, subcarriers), chunk by chunk
+        name_file = './phase_processing/signal_' + name + '.npy'
+        signal_file = NpyAppender(name_file, (n_tot, plan.n_data), complex)
+        csi_blocks = signal_blocks(extract_cores(cores_chunks, ncore, nsubchannels, n_ss), plan, start)
+        if args.hampel_window > 0:
+            csi_blocks = hampel_filter_blocks(csi_blocks, args.hampel_window, args.hampel_sigmas,
+                                              args.hampel_memory)
+        for csi_block in csi_blocks:
+            signal_file.append(csi_block)
+        signal_file.close()
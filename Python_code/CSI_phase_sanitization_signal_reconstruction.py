@@ -21,6 +21,100 @@ from os import listdir, path
 import pickle
 import math as mt
 import os
+from storage_utility import CompactStream, save_sanitized_csi
+from band_utility import band_plan
+
+
+def phase_jump_corrections(diff_phase_err, threshold):
+    # corrections, in multiples of 2 pi, of the diff along the subcarriers of the phase error of each packet (column)
+    # as done by the loop that corrects the first jump up (or, if there is none, the first jump down) until no jump is
+    # left or the same jump is found twice in a row (to avoid a continuous jump): the jumps up are corrected in order
+    # up to the first one that is still up after the correction, where the loop stops; otherwise the jumps down are
+    # corrected in order, unless the first one is the last jump up corrected, up to the first one that is still a
+    # jump after the correction
+    n_rows = diff_phase_err.shape[0]
+    rows = np.arange(n_rows)[:, None]
+
+    invert_up = diff_phase_err > threshold
+    still_up = invert_up & (diff_phase_err - 2 * mt.pi > threshold)
+    any_still_up = np.any(still_up, axis=0)
+    last_up = np.where(any_still_up, np.argmax(still_up, axis=0), n_rows)
+    jumps = -(invert_up & (rows <= last_up)).astype(int)
+    idx_prec = np.where(np.any(invert_up, axis=0), n_rows - 1 - np.argmax(invert_up[::-1], axis=0), -1)
+
+    diff_phase_err = diff_phase_err + 2 * mt.pi * jumps
+    invert_down = (diff_phase_err < -threshold) & ~any_still_up
+    invert_down &= np.argmax(invert_down, axis=0) != idx_prec
+    still_jump = invert_down & (np.abs(diff_phase_err + 2 * mt.pi) > threshold)
+    last_down = np.where(np.any(still_jump, axis=0), np.argmax(still_jump, axis=0), n_rows)
+    jumps += invert_down & (rows <= last_down)
+    return jumps
+
+
+def correct_phase_jumps(phase_before, max_block_size=1024):
+    # removes in place the 2 pi jumps along the subcarriers of the phase error between each packet and the previous
+    # corrected one. The corrections of a packet depend on those of the previous packet: for a block of packets those
+    # of the previous packets are guessed all at once by unwrapping the diff along the subcarriers over the packets,
+    # and the corrections are kept up to the first packet where they differ from the guess (included, its previous
+    # packet was guessed right). The block grows while the guesses hold
+    threshold = 0.9 * mt.pi
+    n_packets = phase_before.shape[1]
+    phase_diff_prec = np.diff(phase_before[:, 0])  # diff along the subcarriers before the corrections
+    jumps_prec = np.zeros(phase_diff_prec.shape[0], dtype=int)
+    block_size = max_block_size
+    tidx = 1
+    while tidx < n_packets:
+        block_end = min(tidx + block_size, n_packets)
+        phase_diff = np.diff(phase_before[:, tidx:block_end], axis=0)
+        phase_err_diff = np.diff(np.concatenate((phase_diff_prec[:, None], phase_diff), axis=1), axis=1)
+
+        wrap_jumps = np.rint(((np.mod(phase_err_diff + mt.pi, 2 * mt.pi) - mt.pi) - phase_err_diff) / (2 * mt.pi))
+        jumps_guess = jumps_prec[:, None] + np.cumsum(wrap_jumps.astype(int), axis=1)
+        jumps_before = np.concatenate((jumps_prec[:, None], jumps_guess[:, :-1]), axis=1)
+        jumps = phase_jump_corrections(phase_err_diff - 2 * mt.pi * jumps_before, threshold)
+
+        guessed = np.all(jumps == jumps_guess, axis=0)
+        if np.all(guessed):
+            n_corrected = block_end - tidx
+            block_size = min(2 * block_size, max_block_size)
+        else:
+            n_corrected = np.argmin(guessed) + 1
+            block_size = 2 * n_corrected
+        phase_before[1:, tidx:tidx + n_corrected] += 2 * mt.pi * np.cumsum(jumps[:, :n_corrected], axis=0)
+        phase_diff_prec = phase_diff[:, n_corrected - 1]
+        jumps_prec = jumps[:, n_corrected - 1]
+        tidx += n_corrected
+
+
+def detrend_phase(phase_before):
+    # removes in place from each packet (column) but the first and the last the least squares line (intercept and
+    # slope along the subcarriers) of the phase error with respect to the previous detrended packet. The projector on
+    # the lines is the same for all the packets and the line of each detrended packet is the one of the first packet,
+    # so the phase error of every packet is taken with respect to the first one, all at once
+    ones_vector = np.ones((2, phase_before.shape[0]))
+    ones_vector[1, :] = np.arange(0, phase_before.shape[0])
+    fit_matrix = np.linalg.pinv(ones_vector.T)  # (2, subcarriers), intercept and slope of a column
+    error = phase_before[:, 1:-1] - phase_before[:, 0:1]
+    phase_before[:, 1:-1] -= np.dot(ones_vector.T, np.dot(fit_matrix, error))
+
+
+def sanitize_phase(H_est):
+    # unwrapped phase of H_est (subcarriers, packets) with the jumps between packets corrected and the linear trend
+    # with respect to the previous packet removed
+    phase_before = np.unwrap(np.angle(H_est), axis=0)
+    correct_phase_jumps(phase_before)
+    detrend_phase(phase_before)
+    return phase_before
+
+
+def sanitized_chunks(amplitude, phase, chunk_size):
+    # (csi_chunk, amplitude_mean_chunk) of save_sanitized_csi from the amplitude and the sanitized phase (subcarriers,
+    # packets)
+    for chunk_start in range(0, amplitude.shape[1], chunk_size):
+        amplitude_chunk = amplitude[:, chunk_start:chunk_start + chunk_size].T
+        csi_chunk = (amplitude_chunk * np.exp(1j * phase[:, chunk_start:chunk_start + chunk_size].T)).astype(
+            np.complex64)
+        yield csi_chunk, np.mean(amplitude_chunk, axis=1)
 
 
 if __name__ == '__main__':
@@ -32,19 +126,30 @@ if __name__ == '__main__':
     parser.add_argument('nsubchannels', help='Number of subchannels', type=int)
     parser.add_argument('start_idx', help='Start index', type=int)
     parser.add_argument('end_idx', help='End index from the end', type=int)
+    parser.add_argument('--storage', help='Output format, npz (complex64 CSI in chunks of packets, memory mapped by '
+                                          'the Doppler computation) or mat (amplitude and phase, as before) '
+                                          '(default npz)', default='npz', required=False, choices=['npz', 'mat'])
+    parser.add_argument('--chunk_size', help='Number of packets in each chunk of the npz output (default 1000)',
+                        default=1000, required=False, type=int)
+    parser.add_argument('--compress', help='Compress the chunks of the npz output (they are then read completely)',
+                        action='store_true', required=False)
     args = parser.parse_args()
 
     exp_dir = args.dir
     save_dir = args.dir_save
+    plan = band_plan(args.nsubchannels)
     names = []
 
+    # outputs of the H estimation, Tr_vector_<name>.txt (pickle) or H_estimation_<name>.npz (compact)
     all_files = listdir(exp_dir)
     for i in range(len(all_files)):
         if all_files[i].startswith('Tr') and all_files[i].endswith('.txt'):
-            names.append(all_files[i][:-4])
+            names.append((all_files[i], all_files[i][10:-4]))
+        elif all_files[i].startswith('H_estimation_') and all_files[i].endswith('.npz'):
+            names.append((all_files[i], all_files[i][13:-4]))
 
-    for name in names:
-        name_f = name[10:] + '.mat'
+    for file_name, name in names:
+        name_f = name + '.' + args.storage
         stop = False
         sub_dir_name = name_f[0:-13]
         subdir_path = save_dir + sub_dir_name
@@ -62,58 +167,34 @@ if __name__ == '__main__':
             os.mkdir(subdir_path)
 
         name_file_save = subdir_path + '/' + name_f
-        name_file = exp_dir + name + '.txt'
-
-        with open(name_file, "rb") as fp:  # Unpickling
-            H_est = pickle.load(fp)
-
-        end_H = H_est.shape[1]
-        H_est = H_est[:, args.start_idx:end_H-args.end_idx]
-        F_frequency = args.nsubchannels
-        csi_matrix_processed = np.zeros((H_est.shape[1], F_frequency, 2))
+        name_file = exp_dir + file_name
+
+        # H_est holds the rows plan.trim of Tr, the trimmed grid
+        if file_name.endswith('.npz'):
+            compact_stream = CompactStream(name_file)
+            end_H = compact_stream.n_packets
+            H_est = compact_stream.Tr(slice(args.start_idx, end_H-args.end_idx)).astype(complex)
+            compact_stream.close()
+        else:
+            with open(name_file, "rb") as fp:  # Unpickling
+                H_est = pickle.load(fp)
+            end_H = H_est.shape[1]
+            H_est = H_est[plan.trim, args.start_idx:end_H-args.end_idx]
 
         # AMPLITUDE
-        csi_matrix_processed[:, 12:-11, 0] = np.abs(H_est[12:-11, :]).T
+        amplitude = np.abs(H_est)
 
         # PHASE
-        phase_before = np.unwrap(np.angle(H_est[12:-11, :]), axis=0)
-        phase_err_tot = np.diff(phase_before, axis=1)
-        ones_vector = np.ones((2, phase_before.shape[0]))
-        ones_vector[1, :] = np.arange(0, phase_before.shape[0])
-        for tidx in range(1, phase_before.shape[1]):
-            stop = False
-            idx_prec = -1
-            while not stop:
-                phase_err = phase_before[:, tidx] - phase_before[:, tidx - 1]
-                diff_phase_err = np.diff(phase_err)
-                idxs_invert_up = np.argwhere(diff_phase_err > 0.9 * mt.pi)[:, 0]
-                idxs_invert_down = np.argwhere(diff_phase_err < -0.9 * mt.pi)[:, 0]
-                if idxs_invert_up.shape[0] > 0:
-                    idx_act = idxs_invert_up[0]
-                    if idx_act == idx_prec:  # to avoid a continuous jump
-                        stop = True
-                    else:
-                        phase_before[idx_act + 1:, tidx] = phase_before[idx_act + 1:, tidx] \
-                                                           - 2 * mt.pi
-                        idx_prec = idx_act
-                elif idxs_invert_down.shape[0] > 0:
-                    idx_act = idxs_invert_down[0]
-                    if idx_act == idx_prec:
-                        stop = True
-                    else:
-                        phase_before[idx_act + 1:, tidx] = phase_before[idx_act + 1:, tidx] \
-                                                           + 2 * mt.pi
-                        idx_prec = idx_act
-                else:
-                    stop = True
-        for tidx in range(1, H_est.shape[1] - 1):
-            val_prec = phase_before[:, tidx - 1:tidx]
-            val_act = phase_before[:, tidx:tidx + 1]
-            error = val_act - val_prec
-            temp2 = np.linalg.lstsq(ones_vector.T, error)[0]
-            phase_before[:, tidx] = phase_before[:, tidx] - (np.dot(ones_vector.T, temp2)).T
-
-        csi_matrix_processed[:, 12:-11, 1] = phase_before.T
-
-        mdic = {"csi_matrix_processed": csi_matrix_processed[:, 12:-11, :]}
-        sio.savemat(name_file_save, mdic)
+        phase_before = sanitize_phase(H_est)
+
+        if args.storage == 'npz':
+            # complex CSI on the trimmed grid, the amplitude normalization of the Doppler computation is stored
+            csi_chunks = sanitized_chunks(amplitude, phase_before, args.chunk_size)
+            save_sanitized_csi(name_file_save, csi_chunks, {'n_subcarriers': plan.n_trimmed}, args.compress)
+        else:
+            csi_matrix_processed = np.zeros((H_est.shape[1], H_est.shape[0], 2))
+            csi_matrix_processed[:, :, 0] = amplitude.T
+            csi_matrix_processed[:, :, 1] = phase_before.T
+
+            mdic = {"csi_matrix_processed": csi_matrix_processed}
+            sio.savemat(name_file_save, mdic)
@@ -0,0 +1,98 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+# IEEE 802.11ax tone plans of the captures, tones -n_subcarriers / 2, ..., n_subcarriers / 2 - 1 (fftshift order):
+#   bandwidth  bandwidth in [MHz] of the capture
+#   guards     number of lower and upper edge tones removed
+#   nulls      (first, last) tones of the DC (and, at 160 MHz, of the gap between the 80 MHz segments) removed
+#   sub_bands  [start, end) tones of the sub bands of the narrower bandwidths used by the Doppler computation
+tone_plans = {
+    256: {'bandwidth': 20, 'guards': (6, 5), 'nulls': [(-1, 1)], 'sub_bands': {}},
+    512: {'bandwidth': 40, 'guards': (12, 11), 'nulls': [(-2, 2)], 'sub_bands': {20: [(-244, -2), (3, 245)]}},
+    1024: {'bandwidth': 80, 'guards': (12, 11), 'nulls': [(-2, 2)],
+           'sub_bands': {40: [(-500, -17), (17, 500)],
+                         20: [(-500, -259), (-258, -17), (17, 258), (259, 500)]}},
+}
+# 160 MHz: two 80 MHz segments centered at -512 and 512
+tone_plans[2048] = {'bandwidth': 160, 'guards': (12, 11), 'nulls': [(-514, -510), (-11, 11), (510, 514)],
+                    'sub_bands': {80: [(-1012, -11), (12, 1013)]}}
+for bandwidth_80, sub_bands_80 in tone_plans[1024]['sub_bands'].items():
+    tone_plans[2048]['sub_bands'][bandwidth_80] = [(start + shift, end + shift) for shift in (-512, 512)
+                                                   for start, end in sub_bands_80]
+
+
+class BandPlan:
+    # index tables of the tone plan of a capture, built once for each number of subcarriers (see band_plan):
+    #   data_idxs      data and pilot subcarriers in fftshift order (the rows of signal_complete)
+    #   data_fft_idxs  the same subcarriers in the order of the capture (before fftshift)
+    #   trim           slice of the full grid without the edge guards (the columns of csi_matrix_processed)
+    def __init__(self, n_subcarriers):
+        tone_plan = tone_plans[n_subcarriers]
+        self.n_subcarriers = n_subcarriers
+        self.bandwidth = tone_plan['bandwidth']
+        self.sub_bands = tone_plan['sub_bands']
+        self.tones = np.arange(n_subcarriers) - n_subcarriers // 2
+
+        guard_low, guard_high = tone_plan['guards']
+        self.trim = slice(guard_low, n_subcarriers - guard_high)
+        null = np.ones(n_subcarriers, dtype=bool)
+        null[self.trim] = False
+        for first_tone, last_tone in tone_plan['nulls']:
+            null[first_tone + n_subcarriers // 2:last_tone + n_subcarriers // 2 + 1] = True
+        self.delete_idxs = np.flatnonzero(null)
+        self.data_idxs = np.flatnonzero(~null)
+        self.data_fft_idxs = (self.data_idxs + n_subcarriers // 2) % n_subcarriers
+        self.n_data = self.data_idxs.shape[0]
+        self.n_trimmed = self.trim.stop - self.trim.start
+
+    def band_rows(self, bandwidth, sub_band):
+        # slice of the full grid with the subcarriers of the sub band (all for the bandwidth of the capture or None)
+        if bandwidth is None or bandwidth == self.bandwidth:
+            return slice(None)
+        if bandwidth not in self.sub_bands or not 1 <= sub_band <= len(self.sub_bands[bandwidth]):
+            raise ValueError('No sub band ' + str(sub_band) + ' of ' + str(bandwidth) + ' MHz in a capture of ' +
+                             str(self.bandwidth) + ' MHz')
+        start_tone, end_tone = self.sub_bands[bandwidth][sub_band - 1]
+        return slice(start_tone + self.n_subcarriers // 2, end_tone + self.n_subcarriers // 2)
+
+    def band_columns(self, bandwidth, sub_band):
+        # the same subcarriers as a slice of the trimmed grid
+        rows = self.band_rows(bandwidth, sub_band)
+        if rows.start is None:
+            return rows
+        return slice(rows.start - self.trim.start, rows.stop - self.trim.start)
+
+
+band_plans = {}
+
+
+def band_plan(n_subcarriers):
+    if n_subcarriers not in band_plans:
+        if n_subcarriers not in tone_plans:
+            raise ValueError('No tone plan for ' + str(n_subcarriers) + ' subcarriers, supported ' +
+                             ', '.join(str(n) for n in tone_plans))
+        band_plans[n_subcarriers] = BandPlan(n_subcarriers)
+    return band_plans[n_subcarriers]
+
+
+def band_plan_of(n_columns, grid='data'):
+    # band plan of an array with n_columns subcarriers of the data ('data') or trimmed ('trimmed') grid
+    for n_subcarriers in tone_plans:
+        plan = band_plan(n_subcarriers)
+        if getattr(plan, 'n_' + grid) == n_columns:
+            return plan
+    raise ValueError('No tone plan with ' + str(n_columns) + ' subcarriers in the ' + grid + ' grid')
@@ -0,0 +1,200 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import math as mt
+import scipy.fft
+from scipy.signal.windows import hann
+
+hann_windows = {}
+
+
+def hann_window(num_symbols):
+    # (num_symbols, 1) hann window of the Doppler computation, built once for each length
+    if num_symbols not in hann_windows:
+        hann_windows[num_symbols] = np.expand_dims(hann(num_symbols), axis=-1)
+    return hann_windows[num_symbols]
+
+
+zoom_matrices = {}
+
+
+def zoom_matrix(num_symbols, bins, n_fft):
+    # (bins, num_symbols) rows of the hann windowed DFT of n_fft points for the fftshifted bins in the slice bins (the
+    # chirp-z transform of the window for the bins of the velocities of interest), built once for each configuration
+    key = (num_symbols, bins.start, bins.stop, n_fft)
+    if key not in zoom_matrices:
+        frequencies = np.arange(bins.start, bins.stop) - n_fft // 2
+        symbols = np.arange(num_symbols)
+        zoom = np.exp(-1j * 2 * np.pi * np.outer(frequencies, symbols) / n_fft) * hann_window(num_symbols)[:, 0]
+        zoom[:, n_fft:] = 0  # the FFT of n_fft points drops the following packets
+        zoom_matrices[key] = zoom
+    return zoom_matrices[key]
+
+
+def velocity_bins(velocity_max, n_fft, Tc, fc, v_light):
+    # slice of the fftshifted bins of the Doppler profile with velocity up to velocity_max [m/s] in absolute value,
+    # the bins are v_light / (Tc * fc * n_fft) apart
+    delta_v = v_light / (Tc * fc * n_fft)
+    n_side = min(int(np.floor(velocity_max / delta_v + 1e-9)), n_fft // 2)
+    return slice(n_fft // 2 - n_side, min(n_fft // 2 + n_side + 1, n_fft))
+
+
+def window_starts(n_packets, num_symbols, sliding):
+    # first packet of each window of the Doppler computation
+    return range(0, n_packets - num_symbols, sliding)
+
+
+def segment_profiles(csi_matrix_complete, num_symbols, sliding, bounds, n_fft=100, workers=-1, memory_budget=4,
+                     bins=None):
+    # Doppler power profiles (segments, windows, bins) of the CSI (packets, subcarriers) summed over the subcarriers
+    # bounds[s]:bounds[s + 1] of each segment s: hann windowed FFT along the packets of each window of num_symbols
+    # packets, every sliding packets, fftshifted. The windows are strided views of the CSI, transformed together in
+    # blocks that fit memory_budget [MB] (small blocks stay in cache); the power is summed before the fftshift, which
+    # only reorders the bins. With the slice bins, only those fftshifted bins are computed, with a product by the
+    # zoom_matrix instead of the FFT
+    csi_matrix_complete = np.nan_to_num(csi_matrix_complete[:, bounds[0]:bounds[-1]])
+    bounds = np.asarray(bounds) - bounds[0]
+    n_windows = len(window_starts(csi_matrix_complete.shape[0], num_symbols, sliding))
+    n_subcarriers = csi_matrix_complete.shape[1]
+    windows = np.lib.stride_tricks.sliding_window_view(csi_matrix_complete, num_symbols, axis=0)[::sliding]
+    windows = windows[:n_windows].transpose(0, 2, 1)  # (windows, num_symbols, subcarriers)
+    window = hann_window(num_symbols)
+    n_bins = n_fft if bins is None else bins.stop - bins.start
+
+    # windowed CSI, spectrum and power of a window, complex128
+    bytes_window = 16 * n_subcarriers * (num_symbols + 2 * n_bins)
+    block_size = max(int(memory_budget * 2 ** 20 // bytes_window), 1)
+    csi_d_profile_array = np.zeros((bounds.shape[0] - 1, n_windows, n_bins))
+    for block_start in range(0, n_windows, block_size):
+        block_end = min(block_start + block_size, n_windows)
+        if bins is None:
+            csi_matrix_wind = np.multiply(windows[block_start:block_end], window,
+                                          dtype=np.result_type(csi_matrix_complete, window))
+            csi_doppler_prof = scipy.fft.fft(csi_matrix_wind, n=n_fft, axis=1, workers=workers)
+        else:
+            csi_doppler_prof = np.matmul(zoom_matrix(num_symbols, bins, n_fft), windows[block_start:block_end])
+        # |X conj(X)| as the real part of X conj(X), the same rounding
+        csi_d_map = np.conj(csi_doppler_prof)
+        np.multiply(csi_doppler_prof, csi_d_map, out=csi_d_map)
+        for segment in range(bounds.shape[0] - 1):
+            csi_d_profile_array[segment, block_start:block_end] = np.sum(
+                csi_d_map.real[:, :, bounds[segment]:bounds[segment + 1]], axis=2)
+    if bins is None:
+        csi_d_profile_array = scipy.fft.fftshift(csi_d_profile_array, axes=2)
+    return csi_d_profile_array
+
+
+def doppler_profiles(csi_matrix_complete, num_symbols, sliding, n_fft=100, workers=-1, memory_budget=4, bins=None):
+    # Doppler power profile (windows, bins) of the CSI (packets, subcarriers), summed over all the subcarriers
+    return segment_profiles(csi_matrix_complete, num_symbols, sliding, [0, csi_matrix_complete.shape[1]], n_fft,
+                            workers, memory_budget, bins)[0]
+
+
+def band_profiles(csi_matrix_complete, num_symbols, sliding, bands_columns, n_fft=100, workers=-1, memory_budget=4,
+                  bins=None):
+    # Doppler power profiles of the CSI for the subcarriers of each slice of bands_columns, with one FFT of each
+    # subcarrier: the power is summed over the segments between the edges of all the bands and the profile of a band
+    # is the sum of its segments
+    bounds = sorted(set(edge for columns in bands_columns for edge in (columns.start, columns.stop)))
+    csi_d_segments = segment_profiles(csi_matrix_complete, num_symbols, sliding, bounds, n_fft, workers,
+                                      memory_budget, bins)
+    return [np.sum(csi_d_segments[bounds.index(columns.start):bounds.index(columns.stop)], axis=0)
+            for columns in bands_columns]
+
+
+def normalize_profiles(csi_d_profile_array, noise_lev):
+    # profiles normalized by their maximum, the values below 10^noise_lev are set to 10^noise_lev
+    csi_d_profile_array = csi_d_profile_array / np.max(csi_d_profile_array, axis=1, keepdims=True)
+    csi_d_profile_array[csi_d_profile_array < mt.pow(10, noise_lev)] = mt.pow(10, noise_lev)
+    return csi_d_profile_array
+
+
+class StreamingDoppler:
+    # Doppler profiles of a stream of packets, as computed by the Doppler computation on the packets received so far:
+    # the profile of the window of num_symbols packets starting at packet i (i multiple of sliding) is given when the
+    # packet i + num_symbols is pushed. The sanitized CSI (packets, subcarriers of the trimmed grid) is normalized by
+    # the mean amplitude of each packet and restricted to band_columns. The spectrum of the last num_symbols packets
+    # is updated at each packet with a sliding DFT at the frequencies of the bins and at the frequencies shifted by
+    # +-1 / (num_symbols - 1), whose combination is the hann windowed DFT; it is computed again from the ring buffer
+    # every refresh packets to bound the rounding errors of the recursion
+    def __init__(self, num_symbols, sliding, noise_lev, band_columns=slice(None), n_fft=100, bins=None, refresh=1000):
+        if num_symbols > n_fft:
+            raise ValueError('Windows of ' + str(num_symbols) + ' packets longer than the FFT of ' + str(n_fft) +
+                             ' points')
+        self.num_symbols = num_symbols
+        self.sliding = sliding
+        self.noise_lev = noise_lev
+        self.band_columns = band_columns
+        self.refresh = refresh
+        bins = slice(0, n_fft) if bins is None else bins
+        frequencies = (np.arange(bins.start, bins.stop) - n_fft // 2) / n_fft
+        self.n_bins = frequencies.shape[0]
+
+        # hann(num_symbols) = 0.5 - 0.25 exp(1j 2 pi n / (N - 1)) - 0.25 exp(-1j 2 pi n / (N - 1))
+        shift = 1 / (num_symbols - 1) if num_symbols > 1 else 0
+        weights = [0.5, -0.25, -0.25] if num_symbols > 1 else [1, 0, 0]
+        self.frequencies = np.concatenate((frequencies, frequencies - shift, frequencies + shift))[:, None]
+        self.weights = np.repeat(weights, frequencies.shape[0]).reshape(3, -1, 1)
+        self.rotation = np.exp(1j * 2 * np.pi * self.frequencies)
+        self.phase_last = np.exp(-1j * 2 * np.pi * self.frequencies * (num_symbols - 1))
+
+        self.buffer = None  # ring buffer of the last num_symbols packets, packet t in t % num_symbols
+        self.spectrum = None  # sliding DFT of the packets n_packets - num_symbols:n_packets
+        self.n_packets = 0
+        self.n_updates = 0
+
+    def dft(self):
+        # DFT of the packets in the ring buffer at all the frequencies
+        order = (self.n_packets + np.arange(self.num_symbols)) % self.num_symbols
+        phases = np.exp(-1j * 2 * np.pi * self.frequencies * np.arange(self.num_symbols))
+        return np.dot(phases, self.buffer[order])
+
+    def profile(self):
+        # normalized Doppler profile of the packets in the ring buffer
+        csi_doppler_prof = np.sum(self.weights * self.spectrum.reshape(self.weights.shape[0], -1,
+                                                                         self.spectrum.shape[1]), axis=0)
+        csi_d_map = np.conj(csi_doppler_prof)
+        np.multiply(csi_doppler_prof, csi_d_map, out=csi_d_map)
+        return normalize_profiles(np.sum(csi_d_map.real, axis=1)[None, :], self.noise_lev)[0]
+
+    def push(self, csi_packets):
+        # profiles (windows, bins) completed by the packets (packets, subcarriers)
+        amplitude_mean = np.mean(np.abs(csi_packets), axis=1, keepdims=True)
+        csi_packets = np.nan_to_num(csi_packets[:, self.band_columns] / amplitude_mean)
+        if self.buffer is None:
+            self.buffer = np.zeros((self.num_symbols, csi_packets.shape[1]), dtype=complex)
+            self.spectrum = np.zeros((self.frequencies.shape[0], csi_packets.shape[1]), dtype=complex)
+
+        profiles = []
+        for csi_packet in csi_packets:
+            if self.n_packets >= self.num_symbols and (self.n_packets - self.num_symbols) % self.sliding == 0:
+                profiles.append(self.profile())
+
+            slot = self.n_packets % self.num_symbols
+            if self.n_packets < self.num_symbols:
+                self.spectrum += np.exp(-1j * 2 * np.pi * self.frequencies * self.n_packets) * csi_packet
+                self.buffer[slot] = csi_packet
+            else:
+                self.spectrum -= self.buffer[slot]
+                self.spectrum *= self.rotation
+                self.spectrum += self.phase_last * csi_packet
+                self.buffer[slot] = csi_packet
+                self.n_updates += 1
+            self.n_packets += 1
+            if self.n_updates >= self.refresh:
+                self.spectrum = self.dft()
+                self.n_updates = 0
+        return np.array(profiles).reshape(len(profiles), self.n_bins)
@@ -0,0 +1,256 @@
+
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import scipy.io as sio
+import io
+import struct
+import zlib
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# MAT-file v5 data types and classes
+miINT8 = 1
+miINT32 = 5
+miUINT32 = 6
+miSINGLE = 7
+miDOUBLE = 9
+miMATRIX = 14
+miCOMPRESSED = 15
+mxCELL_CLASS = 1
+mx_complex_flag = 0x800
+mi_dtypes = {miSINGLE: 'f4', miDOUBLE: 'f8'}
+
+
+class FileStream:
+    # bytes [start, end) of a file
+    def __init__(self, fp, start, end):
+        self.fp = fp
+        self.fp.seek(start)
+        self.remaining = end - start
+
+    def read(self, n):
+        data = self.fp.read(min(n, self.remaining))
+        self.remaining -= len(data)
+        if len(data) < n:
+            raise EOFError('Truncated MAT-file')
+        return data
+
+
+class ZlibStream:
+    # decompressed content of the miCOMPRESSED element stored in bytes [start, end) of a file, decompressed on demand
+    def __init__(self, fp, start, end, block_size=1 << 20):
+        self.file_stream = FileStream(fp, start, end)
+        self.decompressor = zlib.decompressobj()
+        self.block_size = block_size
+        self.buffer = bytearray()
+
+    def read(self, n):
+        while len(self.buffer) < n:
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.unconsumed_tail
+            else:
+                data = self.file_stream.read(min(self.block_size, self.file_stream.remaining))
+                if len(data) == 0:
+                    raise EOFError('Truncated MAT-file')
+            self.buffer += self.decompressor.decompress(data, max(n - len(self.buffer), self.block_size))
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+
+def read_tag(stream, endian):
+    # (type, size, data of the small element format or None)
+    tag = stream.read(8)
+    data_type, size = struct.unpack(endian + 'II', tag)
+    if data_type >> 16:
+        # small data element: type and size in the first 4 bytes, data in the last 4
+        return data_type & 0xFFFF, data_type >> 16, tag[4:4 + (data_type >> 16)]
+    return data_type, size, None
+
+
+def read_element(stream, endian):
+    data_type, size, data = read_tag(stream, endian)
+    if data is None:
+        data = stream.read(size)
+        stream.read((8 - size % 8) % 8)
+    return data_type, data
+
+
+def matrix_header(stream, endian):
+    # array flags, dimensions and name of a miMATRIX element
+    _, flags = read_element(stream, endian)
+    _, dims = read_element(stream, endian)
+    _, name = read_element(stream, endian)
+    dims = struct.unpack(endian + str(len(dims) // 4) + 'i', dims)
+    return flags, dims, name.decode('latin1')
+
+
+def cell_chunk(header, flags, cells, endian):
+    # cell array (1, len(cells)) of the miMATRIX elements in cells, loaded as by sio.loadmat
+    dims = struct.pack(endian + 'II', miINT32, 8) + struct.pack(endian + 'ii', 1, len(cells))
+    name = struct.pack(endian + 'I', (1 << 16) | miINT8) + b'c\0\0\0'
+    flags = struct.pack(endian + 'II', miUINT32, len(flags)) + flags
+    content = flags + dims + name + b''.join(cells)
+    matrix = struct.pack(endian + 'II', miMATRIX, len(content)) + content
+    return sio.loadmat(io.BytesIO(header + matrix))['c']
+
+
+def iterate_cell_v5(name_file, variable_name, chunk_size):
+    # cells of a MAT-file v5 cell array in chunks of chunk_size cells, only one chunk in memory at a time
+    with open(name_file, 'rb') as fp:
+        header = fp.read(128)
+        endian = '<' if header[126:128] == b'IM' else '>'
+        fp.seek(0, 2)
+        file_size = fp.tell()
+        position = 128
+        while position + 8 <= file_size:
+            fp.seek(position)
+            data_type, size = struct.unpack(endian + 'II', fp.read(8))
+            next_position = position + 8 + size
+            if data_type == miCOMPRESSED:
+                stream = ZlibStream(fp, position + 8, next_position)
+                data_type, size = struct.unpack(endian + 'II', stream.read(8))
+            elif data_type == miMATRIX:
+                stream = FileStream(fp, position + 8, next_position)
+                next_position += (8 - size % 8) % 8
+            if data_type == miMATRIX:
+                flags, dims, name = matrix_header(stream, endian)
+                if name == variable_name:
+                    if struct.unpack(endian + 'I', flags[:4])[0] & 0xFF != mxCELL_CLASS:
+                        break
+                    n_cells = int(np.prod(dims))
+                    for cell_start in range(0, n_cells, chunk_size):
+                        cells = []
+                        for _ in range(cell_start, min(cell_start + chunk_size, n_cells)):
+                            tag = stream.read(8)
+                            cell_size = struct.unpack(endian + 'II', tag)[1]
+                            cells.append(tag + stream.read(cell_size))
+                        yield cell_chunk(header, flags, cells, endian)
+                    return
+            position = next_position
+
+    # not a cell array, loaded at once
+    variable = sio.loadmat(name_file, variable_names=[variable_name])[variable_name]
+    variable = np.reshape(variable, (1, -1), order='F')
+    for cell_start in range(0, variable.shape[1], chunk_size):
+        yield variable[:, cell_start:cell_start + chunk_size]
+
+
+def matrix_memmap_v5(name_file, variable_name):
+    # real single or double variable of an uncompressed MAT-file v5 memory mapped with the MATLAB (column-major)
+    # layout, None if it is compressed or of another type
+    with open(name_file, 'rb') as fp:
+        header = fp.read(128)
+        if header.startswith(b'MATLAB 7.3'):
+            return None
+        endian = '<' if header[126:128] == b'IM' else '>'
+        fp.seek(0, 2)
+        file_size = fp.tell()
+        position = 128
+        while position + 8 <= file_size:
+            fp.seek(position)
+            data_type, size = struct.unpack(endian + 'II', fp.read(8))
+            next_position = position + 8 + size
+            if data_type == miMATRIX:
+                next_position += (8 - size % 8) % 8
+                stream = FileStream(fp, position + 8, position + 8 + size)
+                flags, dims, name = matrix_header(stream, endian)
+                if name == variable_name:
+                    if struct.unpack(endian + 'I', flags[:4])[0] & mx_complex_flag:
+                        return None
+                    data_type, data_size, data = read_tag(stream, endian)
+                    if data is not None or data_type not in mi_dtypes:
+                        return None
+                    dtype = np.dtype(endian + mi_dtypes[data_type])
+                    if data_size != np.prod(dims) * dtype.itemsize:
+                        return None
+                    if data_size == 0:
+                        return np.empty(dims, dtype=dtype)
+                    return np.memmap(name_file, dtype=dtype, mode='r', offset=fp.tell(), shape=dims, order='F')
+            position = next_position
+    return None
+
+
+def load_rows(name_file, variable_name, rows):
+    # rows (a slice of the first axis) of a numeric variable of a .mat file, only these rows are read when the file is
+    # an uncompressed MAT-file v5 (as written by sio.savemat)
+    variable = matrix_memmap_v5(name_file, variable_name)
+    if variable is None:
+        variable = sio.loadmat(name_file, variable_names=[variable_name])[variable_name]
+    return np.array(variable[rows])
+
+
+def hdf5_to_mat(h5_file, h5_object):
+    # MAT-file v7.3 (HDF5) object converted to the layout of sio.loadmat: cells as object arrays, structs as record
+    # arrays, arrays with the MATLAB dimensions
+    if isinstance(h5_object, h5py.Group):
+        fields = [field for field in h5_object.keys() if not field.startswith('#')]
+        # in a struct array each field is a dataset of references to the values of the elements
+        struct_array = [field for field in fields if 'MATLAB_class' not in h5_object[field].attrs and
+                        h5_object[field].dtype == h5py.ref_dtype]
+        dims = h5_object[struct_array[0]].shape[::-1] if struct_array else (1, 1)
+        mat_struct = np.empty(dims, dtype=[(field, object) for field in fields])
+        for field in fields:
+            if struct_array:
+                references = h5_object[field][()].T
+                for idx in np.ndindex(*dims):
+                    mat_struct[idx][field] = hdf5_to_mat(h5_file, h5_file[references[idx]])
+            else:
+                mat_struct[0, 0][field] = hdf5_to_mat(h5_file, h5_object[field])
+        return mat_struct
+
+    if h5_object.attrs.get('MATLAB_empty', 0):
+        return np.empty((0, 0), dtype=object)
+    matlab_class = h5_object.attrs.get('MATLAB_class', b'')
+    if isinstance(matlab_class, bytes):
+        matlab_class = matlab_class.decode()
+    data = h5_object[()]
+    if matlab_class == 'cell':
+        references = data.T
+        cell = np.empty(references.shape, dtype=object)
+        for idx in np.ndindex(*references.shape):
+            cell[idx] = hdf5_to_mat(h5_file, h5_file[references[idx]])
+        return cell
+    if data.dtype.names is not None and 'real' in data.dtype.names:
+        data = data['real'] + 1j * data['imag']
+    return np.atleast_2d(data.T)
+
+
+def iterate_cell_hdf5(name_file, variable_name, chunk_size):
+    if h5py is None:
+        raise ImportError('h5py is needed to read the MAT-file v7.3 ' + name_file)
+    with h5py.File(name_file, 'r') as h5_file:
+        references = h5_file[variable_name][()].ravel()  # MATLAB (column-major) order
+        for cell_start in range(0, references.shape[0], chunk_size):
+            references_chunk = references[cell_start:cell_start + chunk_size]
+            cells = np.empty((1, references_chunk.shape[0]), dtype=object)
+            for idx, reference in enumerate(references_chunk):
+                cells[0, idx] = hdf5_to_mat(h5_file, h5_file[reference])
+            yield cells
+
+
+def iterate_cell(name_file, variable_name, chunk_size):
+    # cell array variable_name of a .mat file (v5 or v7.3) as (1, chunk_size) object arrays, as sliced from the
+    # output of sio.loadmat
+    with open(name_file, 'rb') as fp:
+        header = fp.read(128)
+    if header.startswith(b'MATLAB 7.3'):
+        return iterate_cell_hdf5(name_file, variable_name, chunk_size)
+    return iterate_cell_v5(name_file, variable_name, chunk_size)
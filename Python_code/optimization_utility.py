@@ -15,9 +15,12 @@
 """
 
 import numpy as np
-import cmath as cmt
 import osqp
 import scipy
+import scipy.fft
+import scipy.linalg
+import time
+from collections import OrderedDict
 
 
 def convert_to_complex_osqp(real_im_n):
@@ -27,19 +30,133 @@ def convert_to_complex_osqp(real_im_n):
 
 
 def build_T_matrix(frequency_vector, delta_t_, t_min_, t_max_):
-    F_frequency = frequency_vector.shape[0]
     L_paths = int((t_max_ - t_min_) / delta_t_)
-    T_matrix = np.zeros((F_frequency, L_paths), dtype=complex)
-    time_matrix = np.zeros((L_paths,))
-    for col in range(L_paths):
-        time_col = t_min_ + delta_t_ * col
-        time_matrix[col] = time_col
-        for row in range(F_frequency):
-            freq_n = frequency_vector[row]
-            T_matrix[row, col] = cmt.exp(-1j * 2 * cmt.pi * freq_n * time_col)
+    time_matrix = t_min_ + delta_t_ * np.arange(L_paths)
+    T_matrix = np.exp(-1j * 2 * np.pi * np.outer(frequency_vector, time_matrix))
     return T_matrix, time_matrix
 
 
+def cache_lookup(cache, cache_size, key, build_fn):
+    # bounded LRU cache lookup, build_fn() is called on a miss
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    value = build_fn()
+    cache[key] = value
+    if len(cache) > cache_size:
+        cache.popitem(last=False)
+    return value
+
+
+T_matrix_cache = OrderedDict()
+T_matrix_cache_size = 64
+
+
+def build_T_matrix_cached(frequency_vector, delta_t_, t_min_, t_max_):
+    # cached build_T_matrix, the returned matrices are shared and read-only
+    def build_fn():
+        T_matrix, time_matrix = build_T_matrix(frequency_vector, delta_t_, t_min_, t_max_)
+        T_matrix.setflags(write=False)
+        time_matrix.setflags(write=False)
+        return T_matrix, time_matrix
+
+    key = (delta_t_, t_min_, t_max_, frequency_vector.shape[0], frequency_vector.tobytes())
+    return cache_lookup(T_matrix_cache, T_matrix_cache_size, key, build_fn)
+
+
+class ChirpZ:
+    # X[k] = sum_n x[n] exp(-1j * 2 * pi * phi * n * k), n < n_in, k < m_out, along axis 0 (Bluestein algorithm)
+    def __init__(self, n_in, m_out, phi):
+        self.n_in = n_in
+        self.m_out = m_out
+        self.n_fft = scipy.fft.next_fast_len(n_in + m_out - 1)
+        n = np.arange(max(n_in, m_out))
+        chirp = np.exp(-1j * np.pi * phi * n.astype(float) ** 2)
+        self.chirp_in = chirp[:n_in, None]
+        self.chirp_out = chirp[:m_out, None]
+        chirp_conv = np.zeros(self.n_fft, dtype=complex)
+        chirp_conv[:m_out] = np.conj(chirp[:m_out])
+        chirp_conv[self.n_fft - n_in + 1:] = np.conj(chirp[1:n_in][::-1])
+        self.chirp_conv_fft = scipy.fft.fft(chirp_conv)[:, None]
+
+    def __call__(self, x):
+        x_2d = x.reshape(x.shape[0], -1)
+        x_fft = scipy.fft.fft(x_2d * self.chirp_in, n=self.n_fft, axis=0)
+        out = scipy.fft.ifft(x_fft * self.chirp_conv_fft, axis=0)[:self.m_out] * self.chirp_out
+        return out.reshape((self.m_out,) + x.shape[1:])
+
+
+class DelayOperator:
+    # T matrix of build_T_matrix applied with chirp-z transforms, without building it, for frequencies on the
+    # subcarrier grid (frequency_vector = delta_f * integer). T[f, l] = exp(-1j 2 pi delta_f k_f (t_min + delta_t l))
+    def __init__(self, frequency_vector, delta_t_, t_min_, t_max_, delta_f=78.125E3):
+        k_vector = np.round(frequency_vector / delta_f).astype(int)
+        if not np.allclose(k_vector * delta_f, frequency_vector, rtol=0, atol=1E-6 * delta_f):
+            raise ValueError('Frequencies not on a uniform grid of step ' + str(delta_f))
+        L_paths = int((t_max_ - t_min_) / delta_t_)
+        self.time_matrix = t_min_ + delta_t_ * np.arange(L_paths)
+        self.frequency_vector = frequency_vector
+        self.shape = (frequency_vector.shape[0], L_paths)
+        k_min = np.min(k_vector)
+        n_k = np.max(k_vector) - k_min + 1
+        self.k_idx = k_vector - k_min
+        phi = delta_f * delta_t_
+        self.phase_row = np.exp(-1j * 2 * np.pi * frequency_vector * t_min_)[:, None]
+        self.phase_col = np.exp(-1j * 2 * np.pi * phi * k_min * np.arange(L_paths))[:, None]
+        self.czt_forward = ChirpZ(L_paths, n_k, phi)
+        self.czt_adjoint = ChirpZ(n_k, L_paths, -phi)
+        self.H = DelayOperatorAdjoint(self)
+        self.gram_matrix = None
+
+    def matvec(self, x):
+        x_2d = x.reshape(x.shape[0], -1)
+        y = self.czt_forward(x_2d * self.phase_col)[self.k_idx] * self.phase_row
+        return y.reshape((self.shape[0],) + x.shape[1:])
+
+    def rmatvec(self, y):
+        y_2d = y.reshape(y.shape[0], -1)
+        y_scattered = np.zeros((self.czt_adjoint.n_in, y_2d.shape[1]), dtype=complex)
+        y_scattered[self.k_idx] = y_2d * np.conj(self.phase_row)
+        x = self.czt_adjoint(y_scattered) * np.conj(self.phase_col)
+        return x.reshape((self.shape[1],) + y.shape[1:])
+
+    def column(self, col):
+        return np.exp(-1j * 2 * np.pi * self.frequency_vector * self.time_matrix[col])
+
+    def toarray(self):
+        return np.exp(-1j * 2 * np.pi * np.outer(self.frequency_vector, self.time_matrix))
+
+    def gram(self):
+        # T^H T, Hermitian Toeplitz as its entries depend on the delay difference only: built from its first column
+        # (one chirp-z transform) on the first call
+        if self.gram_matrix is None:
+            gram_column = self.rmatvec(self.column(0))
+            self.gram_matrix = scipy.linalg.toeplitz(gram_column, np.conj(gram_column))
+        return self.gram_matrix
+
+    def __matmul__(self, x):
+        return self.matvec(x)
+
+
+class DelayOperatorAdjoint:
+    def __init__(self, operator):
+        self.operator = operator
+        self.shape = (operator.shape[1], operator.shape[0])
+
+    def __matmul__(self, y):
+        return self.operator.rmatvec(y)
+
+
+delay_operator_cache = OrderedDict()
+delay_operator_cache_size = 64
+
+
+def build_delay_operator_cached(frequency_vector, delta_t_, t_min_, t_max_):
+    key = (delta_t_, t_min_, t_max_, frequency_vector.shape[0], frequency_vector.tobytes())
+    return cache_lookup(delay_operator_cache, delay_operator_cache_size, key,
+                        lambda: DelayOperator(frequency_vector, delta_t_, t_min_, t_max_))
+
+
 def lasso_regression_osqp_fast(H_matrix_, T_matrix_, selected_subcarriers, row_T, col_T, Im, Onm, P, q, A2, A3,
                                ones_n_matr, zeros_n_matr, zeros_nm_matr):
     # time_start = time.time()
@@ -69,7 +186,7 @@ def lasso_regression_osqp_fast(H_matrix_, T_matrix_, selected_subcarriers, row_T
     prob = osqp.OSQP()
 
     # Setup workspace
-    prob.setup(P, q, A, l, u, warm_start=True, verbose=False)
+    prob.setup(P, q, A, l, u, warm_starting=True, verbose=False)
 
     # Update linear cost
     lambd = 1E-1
@@ -77,10 +194,266 @@ def lasso_regression_osqp_fast(H_matrix_, T_matrix_, selected_subcarriers, row_T
     prob.update(q=q_new)
 
     # Solve
-    res = prob.solve()
+    res = prob.solve(raise_error=False)
 
     x_out = res.x
     x_out_cut = x_out[:n]
 
     r_opt = convert_to_complex_osqp(x_out_cut)
     return r_opt
+
+
+class HotPathProfiler:
+    # opt-in timings [s] and solver statistics of the H estimation kept in columns, one row per packet (per block of
+    # packets for the batched solvers); when disabled every call returns immediately
+    time_fields = ('t_matrix', 'assembly', 'setup', 'solve', 'reconstruction')
+    stat_fields = ('packet', 'packets', 'solves', 'iterations', 'non_converged', 'status')
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.columns = {field: [] for field in self.time_fields + self.stat_fields}
+        self.row = None
+
+    def clock(self):
+        if not self.enabled:
+            return 0.
+        return time.perf_counter()
+
+    def start_row(self, packet, packets=1):
+        if not self.enabled:
+            return
+        self.row = dict.fromkeys(self.time_fields, 0.)
+        self.row.update(packet=packet, packets=packets, solves=0, iterations=0, non_converged=0, status=1)
+
+    def add_time(self, field, time_start):
+        if not self.enabled:
+            return
+        self.row[field] += time.perf_counter() - time_start
+
+    def spread_time(self, field, time_start, rows):
+        # time of an operation done together for rows already ended, split among them
+        if not self.enabled:
+            return
+        time_row = (time.perf_counter() - time_start) / len(rows)
+        for row in rows:
+            self.columns[field][row] += time_row
+
+    def add_solve(self, iterations, non_converged=0, status=1):
+        # status: OSQP status value of the last non converged solve, 1 (solved) if all converged
+        if not self.enabled:
+            return
+        self.row['solves'] += 1
+        self.row['iterations'] += iterations
+        if non_converged > 0:
+            self.row['non_converged'] += non_converged
+            self.row['status'] = status
+
+    def end_row(self):
+        if not self.enabled:
+            return
+        for field in self.columns:
+            self.columns[field].append(self.row[field])
+
+    def arrays(self):
+        arrays = {field: np.asarray(self.columns[field], dtype=float) for field in self.time_fields}
+        arrays.update({field: np.asarray(self.columns[field], dtype=np.int64) for field in self.stat_fields})
+        return arrays
+
+
+hot_path_disabled = HotPathProfiler(enabled=False)
+
+
+def concatenate_hot_path(hot_path_list):
+    return {field: np.concatenate([hot_path[field] for hot_path in hot_path_list]) for field in hot_path_list[0]}
+
+
+def hot_path_summary(hot_path, n_slowest=5, n_non_converged=10):
+    # table of the percentiles of the timings, slowest packets and non converged solves
+    total = sum(hot_path[field] for field in HotPathProfiler.time_fields)
+    lines = ['%-16s %10s %10s %10s %10s %10s' % ('[ms]', 'p50', 'p90', 'p99', 'max', 'total [s]')]
+    for field, values in [(field, hot_path[field]) for field in HotPathProfiler.time_fields] + [('total', total)]:
+        if values.shape[0] == 0:
+            continue
+        p50, p90, p99 = np.percentile(values, [50, 90, 99]) * 1E3
+        lines.append('%-16s %10.2f %10.2f %10.2f %10.2f %10.2f' % (field, p50, p90, p99, np.max(values) * 1E3,
+                                                                   np.sum(values)))
+    slowest = np.argsort(total)[::-1][:n_slowest]
+    lines.append('slowest: ' + ', '.join('packet %d (%.1f ms, %d iterations)' % (hot_path['packet'][idx],
+                                                                                total[idx] * 1E3,
+                                                                                hot_path['iterations'][idx])
+                                         for idx in slowest))
+    non_converged = np.flatnonzero(hot_path['non_converged'] > 0)
+    lines.append('non converged solves: %d in %d rows' % (np.sum(hot_path['non_converged']), non_converged.shape[0]))
+    if non_converged.shape[0] > 0:
+        lines.append('  ' + ', '.join('packet %d (status %d)' % (hot_path['packet'][idx], hot_path['status'][idx])
+                                      for idx in non_converged[:n_non_converged]))
+    return '\n'.join(lines)
+
+
+# solver profiles: tolerances and iteration budget of OSQP (with polishing and adaptive rho) and of the batched
+# ADMM/FISTA solvers, balanced corresponds to the OSQP defaults
+solver_profiles = {
+    'fast': {'osqp': {'eps_abs': 1E-2, 'eps_rel': 1E-2, 'max_iter': 500, 'polishing': False, 'adaptive_rho': True,
+                      'adaptive_rho_interval': 25},
+             'batch': {'eps_abs': 1E-2, 'eps_rel': 1E-2, 'max_iter': 500}},
+    'balanced': {'osqp': {'eps_abs': 1E-3, 'eps_rel': 1E-3, 'max_iter': 4000, 'polishing': False,
+                          'adaptive_rho': True},
+                 'batch': {'eps_abs': 1E-3, 'eps_rel': 1E-3, 'max_iter': 4000}},
+    'reference': {'osqp': {'eps_abs': 1E-5, 'eps_rel': 1E-5, 'max_iter': 20000, 'polishing': True,
+                           'adaptive_rho': True},
+                  'batch': {'eps_abs': 1E-5, 'eps_rel': 1E-5, 'max_iter': 20000}},
+}
+
+
+class LassoOSQPWorkspace:
+    # OSQP problem of the LASSO of lasso_regression_osqp_fast, in the variables x = [Re(r), Im(r)] and t >= |x| only:
+    # min 0.5 x^T G x - (T_real^T H_real)^T x + lambd 1^T t with -t <= x <= t, G = T_real^T T_real. The residual
+    # T_real x - H_real is not a variable, so the KKT system holds the (2 col_T, 2 col_T) Gram matrix instead of the
+    # (2 row_T, 2 col_T) T block of the constraint matrix. One workspace for each T matrix and subcarrier selection
+    # (the caller keys the workspaces by them): set up at the first solve, then only the linear cost is updated
+    def __init__(self, T_matrix_, selected_subcarriers, lambd=1E-1, profiler=hot_path_disabled, **settings):
+        self.profiler = profiler
+        self.selected_subcarriers = selected_subcarriers
+        self.T_matrix_selected = T_matrix_[selected_subcarriers, :]
+        self.row_T, self.col_T = self.T_matrix_selected.shape
+        n = 2 * self.col_T
+        self.n = n
+        self.q = np.hstack([np.zeros(n), lambd * np.ones(n)])
+        self.settings = settings
+        self.prob = None
+        self.T_matrix_real = None
+
+    def setup(self):
+        time_start = self.profiler.clock()
+        n = self.n
+        self.T_matrix_real = np.block([[np.real(self.T_matrix_selected), - np.imag(self.T_matrix_selected)],
+                                       [np.imag(self.T_matrix_selected), np.real(self.T_matrix_selected)]])
+        # P = [[G, 0], [0, 0]], upper triangle of G column by column; A = [[In, -In], [In, In]]
+        P_rows = np.concatenate([np.arange(col + 1) for col in range(n)])
+        P_cols = np.repeat(np.arange(n), np.arange(1, n + 1))
+        P_indptr = np.hstack([0, np.cumsum(np.arange(1, n + 1)), np.full(n, n * (n + 1) // 2)])
+        P_values = (self.T_matrix_real.T @ self.T_matrix_real)[P_rows, P_cols]
+        P = scipy.sparse.csc_matrix((P_values, P_rows, P_indptr), shape=(2 * n, 2 * n))
+        A = scipy.sparse.vstack([scipy.sparse.hstack([scipy.sparse.eye(n), - scipy.sparse.eye(n)]),
+                                 scipy.sparse.hstack([scipy.sparse.eye(n), scipy.sparse.eye(n)])], format='csc')
+        l = np.hstack([- np.inf * np.ones(n), np.zeros(n)])
+        u = np.hstack([np.zeros(n), np.inf * np.ones(n)])
+        self.profiler.add_time('assembly', time_start)
+        time_start = self.profiler.clock()
+        self.prob = osqp.OSQP()
+        self.prob.setup(P, self.q, A, l, u, warm_starting=True, verbose=False, **self.settings)
+        self.profiler.add_time('setup', time_start)
+
+    def solve(self, H_matrix_):
+        if self.prob is None:
+            self.setup()
+        time_start = self.profiler.clock()
+        H_matrix_selected = H_matrix_[self.selected_subcarriers]
+        H_matrix_real = np.hstack([np.real(H_matrix_selected), np.imag(H_matrix_selected)])
+        self.q[:self.n] = - self.T_matrix_real.T @ H_matrix_real
+        self.prob.update(q=self.q)
+        self.profiler.add_time('assembly', time_start)
+
+        time_start = self.profiler.clock()
+        res = self.prob.solve(raise_error=False)
+        self.profiler.add_time('solve', time_start)
+        self.profiler.add_solve(res.info.iter, int(res.info.status != 'solved'), res.info.status_val)
+
+        x_out_cut = res.x[:self.n]
+        r_opt = convert_to_complex_osqp(x_out_cut)
+        return r_opt
+
+
+def soft_threshold_complex(x, threshold):
+    # proximal operator of threshold * (|Re(x)|_1 + |Im(x)|_1), the l1 term of the OSQP formulation
+    return np.sign(x.real) * np.maximum(np.abs(x.real) - threshold, 0) \
+        + 1j * np.sign(x.imag) * np.maximum(np.abs(x.imag) - threshold, 0)
+
+
+class LassoBatchSolver:
+    # complex LASSO min_r 0.5 ||T r - H||^2 + lambd (|Re(r)|_1 + |Im(r)|_1) solved for a block of packets (columns of
+    # H) sharing the same T matrix, with batched ADMM or FISTA iterations
+    def __init__(self, T_matrix_selected, lambd=1E-1, method='admm', rho=3E-2, alpha=1.6, max_iter=4000,
+                 eps_abs=1E-3, eps_rel=1E-3):
+        if method not in ('admm', 'fista'):
+            raise ValueError('Unknown LASSO batch method ' + str(method))
+        # T_matrix_selected is either a dense matrix or a DelayOperator; the iterations only use the small Gram matrix
+        # T^H T (col_T x col_T), the columns being the few delays of the grid
+        self.T_matrix = T_matrix_selected
+        if isinstance(T_matrix_selected, np.ndarray):
+            self.T_matrix_H = np.conj(T_matrix_selected.T)
+            self.gram = self.T_matrix_H @ T_matrix_selected
+        else:
+            self.T_matrix_H = T_matrix_selected.H
+            self.gram = T_matrix_selected.gram()
+        self.col_T = T_matrix_selected.shape[1]
+        self.lambd = lambd
+        self.method = method
+        self.rho = rho
+        self.alpha = alpha
+        self.max_iter = max_iter
+        self.eps_abs = eps_abs
+        self.eps_rel = eps_rel
+        if method == 'admm':
+            self.M_inv = np.linalg.inv(self.gram + rho * np.eye(self.col_T))
+        else:
+            # 1 / Lipschitz constant of the gradient, the largest eigenvalue of T^H T
+            self.step = 1 / np.linalg.eigvalsh(self.gram)[-1]
+
+    def solve(self, H_block):
+        if self.method == 'admm':
+            return self.solve_admm(H_block)
+        return self.solve_fista(H_block)
+
+    def solve_admm(self, H_block):
+        sqrt_n = np.sqrt(self.col_T)
+        TH = self.M_inv @ (self.T_matrix_H @ H_block)
+        z = np.zeros((self.col_T, H_block.shape[1]), dtype=complex)
+        u = np.zeros_like(z)
+        for it in range(self.max_iter):
+            x = TH + self.rho * (self.M_inv @ (z - u))
+            x_relax = self.alpha * x + (1 - self.alpha) * z
+            z_prev = z
+            z = soft_threshold_complex(x_relax + u, self.lambd / self.rho)
+            u = u + x_relax - z
+
+            prim_res = np.linalg.norm(x - z, axis=0)
+            dual_res = self.rho * np.linalg.norm(z - z_prev, axis=0)
+            eps_prim = sqrt_n * self.eps_abs + self.eps_rel * np.maximum(np.linalg.norm(x, axis=0),
+                                                                         np.linalg.norm(z, axis=0))
+            eps_dual = sqrt_n * self.eps_abs + self.eps_rel * self.rho * np.linalg.norm(u, axis=0)
+            converged = np.logical_and(prim_res <= eps_prim, dual_res <= eps_dual)
+            if np.all(converged):
+                break
+        stats = {'method': 'admm', 'packets': H_block.shape[1], 'iterations': it + 1,
+                 'converged': int(np.sum(converged)), 'max_prim_res': float(np.max(prim_res, initial=0)),
+                 'max_dual_res': float(np.max(dual_res, initial=0))}
+        return z, stats
+
+    def solve_fista(self, H_block):
+        # stops on the norm of the gradient mapping (y - x) / step, zero at the solution, with the tolerance of the
+        # dual residual of the ADMM (rho u tends to the subgradient of the l1 term, of norm up to lambd sqrt(n)): the
+        # step x - x_prev is scaled by the small step 1 / L and stopped the iterations long before the solution
+        sqrt_n = np.sqrt(self.col_T)
+        TH = self.step * (self.T_matrix_H @ H_block)
+        eps_grad = sqrt_n * (self.eps_abs + self.eps_rel * self.lambd)
+        x = np.zeros((self.col_T, H_block.shape[1]), dtype=complex)
+        y = x
+        t_k = np.ones(H_block.shape[1])
+        for it in range(self.max_iter):
+            x_prev = x
+            x = soft_threshold_complex(y - self.step * (self.gram @ y) + TH,
+                                       self.lambd * self.step)
+            grad_res = np.linalg.norm(y - x, axis=0) / self.step
+            converged = grad_res <= eps_grad
+            if np.all(converged):
+                break
+            # gradient based restart of the momentum, packet by packet
+            restart = np.sum(np.real(np.conj(y - x) * (x - x_prev)), axis=0) > 0
+            t_k[restart] = 1
+            t_next = (1 + np.sqrt(1 + 4 * t_k ** 2)) / 2
+            y = x + ((t_k - 1) / t_next) * (x - x_prev)
+            t_k = t_next
+        stats = {'method': 'fista', 'packets': H_block.shape[1], 'iterations': it + 1,
+                 'converged': int(np.sum(converged)), 'max_grad_res': float(np.max(grad_res, initial=0))}
+        return x, stats
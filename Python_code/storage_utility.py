@@ -0,0 +1,263 @@
+
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import json
+import os
+import pickle
+import struct
+import zipfile
+
+# compact output of the H estimation (one .npz file per stream):
+#   header     json string with the delay and frequency grids and the rows of Tr that are stored
+#   r_offsets  first delay index of the window of each packet
+#   r_indptr   r_values[r_indptr[p]:r_indptr[p + 1]] are the entries of packet p starting from r_offsets[p]
+#   r_values   non-zero windows of r_optim, one after the other
+#   Tr         complex64 Tr_matrix[Tr_start_row:Tr_end_row, :] (the data subcarriers)
+compact_format_version = 1
+
+
+def r_windows(r_optim):
+    # first index and length of the part of each column between the first and the last non-zero entry
+    non_zero = r_optim != 0
+    any_non_zero = np.any(non_zero, axis=0)
+    r_length = r_optim.shape[0]
+    first = np.argmax(non_zero, axis=0)
+    last = r_length - 1 - np.argmax(non_zero[::-1, :], axis=0)
+    lengths = np.where(any_non_zero, last - first + 1, 0)
+    first = np.where(any_non_zero, first, 0)
+    return first, lengths
+
+
+def window_mask(r_offsets, r_lengths, r_length):
+    # (packets, r_length) mask of the entries inside the windows, row-major order matches r_values
+    idxs = np.arange(r_length)
+    return (idxs >= r_offsets[:, None]) & (idxs < (r_offsets + r_lengths)[:, None])
+
+
+def save_compact_stream(name_file, r_optim, Tr_matrix, header, Tr_start_row=12, Tr_end_row=-11):
+    Tr_end_row = Tr_end_row % Tr_matrix.shape[0]
+    r_offsets, r_lengths = r_windows(r_optim)
+    r_indptr = np.zeros(r_optim.shape[1] + 1, dtype=np.int64)
+    r_indptr[1:] = np.cumsum(r_lengths)
+    r_values = r_optim.T[window_mask(r_offsets, r_lengths, r_optim.shape[0])]
+
+    header = dict(header, version=compact_format_version, r_length=r_optim.shape[0], n_packets=r_optim.shape[1],
+                  F_frequency=Tr_matrix.shape[0], Tr_start_row=Tr_start_row, Tr_end_row=Tr_end_row)
+    # uncompressed, to load only the members that are needed
+    name_file_tmp = name_file + '.tmp'
+    with open(name_file_tmp, "wb") as fp:
+        np.savez(fp, header=np.array(json.dumps(header)), r_offsets=r_offsets.astype(np.int32), r_indptr=r_indptr,
+                 r_values=r_values, Tr=Tr_matrix[Tr_start_row:Tr_end_row, :].astype(np.complex64))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(name_file_tmp, name_file)
+
+
+def npz_memmap(name_file, member):
+    # array member of an uncompressed .npz file memory mapped, None if the member is compressed
+    with zipfile.ZipFile(name_file) as zip_file:
+        info = zip_file.getinfo(member + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(name_file, 'rb') as fp:
+        fp.seek(info.header_offset)
+        local_header = fp.read(30)
+        if local_header[:4] != b'PK\x03\x04':
+            raise ValueError('Corrupted .npz file ' + name_file)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        fp.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+        offset = fp.tell()
+    if dtype.hasobject:
+        return None
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(name_file, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+class CompactStream:
+    # lazy reader of a file written by save_compact_stream, the arrays are read and expanded only when requested;
+    # Tr and r_values are memory mapped so that only the packets requested are read from the file
+    def __init__(self, name_file):
+        self.name_file = name_file
+        self.data = np.load(name_file, allow_pickle=False)
+        self.header = json.loads(str(self.data['header']))
+        self.n_packets = self.header['n_packets']
+        self.r_length = self.header['r_length']
+        self.members = {}
+
+    def member(self, key):
+        if key not in self.members:
+            self.members[key] = npz_memmap(self.name_file, key)
+            if self.members[key] is None:
+                self.members[key] = self.data[key]
+        return self.members[key]
+
+    def Tr(self, packets=slice(None)):
+        # rows Tr_start_row:Tr_end_row of Tr_matrix
+        return np.array(self.member('Tr')[:, packets])
+
+    def Tr_complete(self, packets=slice(None)):
+        # Tr_matrix with the original number of rows, zero outside the stored ones
+        Tr_data = self.Tr(packets)
+        Tr_matrix = np.zeros((self.header['F_frequency'], Tr_data.shape[1]), dtype=Tr_data.dtype)
+        Tr_matrix[self.header['Tr_start_row']:self.header['Tr_end_row'], :] = Tr_data
+        return Tr_matrix
+
+    def r(self, packets=slice(None)):
+        # dense r_optim for the packets in the range
+        packet_start, packet_end, _ = packets.indices(self.n_packets)
+        packet_end = max(packet_end, packet_start)
+        r_indptr = self.data['r_indptr']
+        r_offsets = self.data['r_offsets'][packet_start:packet_end]
+        r_lengths = np.diff(r_indptr[packet_start:packet_end + 1])
+        r_values = np.array(self.member('r_values')[r_indptr[packet_start]:r_indptr[packet_end]])
+        r_optim = np.zeros((packet_end - packet_start, self.r_length), dtype=r_values.dtype)
+        r_optim[window_mask(r_offsets, r_lengths, self.r_length)] = r_values
+        return r_optim.T
+
+    def close(self):
+        self.members = {}
+        self.data.close()
+
+
+# sanitized CSI of the reconstruction (one .npz file per stream), csi_<k> members of consecutive packets:
+#   header          json string with the number of packets and of subcarriers (trimmed grid of the tone plan)
+#   chunk_indptr    packets chunk_indptr[k]:chunk_indptr[k + 1] are in csi_<k>
+#   amplitude_mean  mean of the amplitude of each packet over all the subcarriers
+#   csi_<k>         complex64 CSI (packets, subcarriers) with the sanitized phase
+sanitized_format_version = 1
+
+
+def save_sanitized_csi(name_file, csi_chunks, header, compress=False):
+    # csi_chunks yields (csi_chunk, amplitude_mean_chunk) of consecutive packets, each chunk is written to the file
+    # when it is given; header holds n_subcarriers. The uncompressed members can be memory mapped
+    name_file_tmp = name_file + '.tmp'
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    chunk_indptr = [0]
+    amplitude_mean = []
+    with open(name_file_tmp, 'wb') as fp_file:
+        with zipfile.ZipFile(fp_file, mode='w', compression=compression, allowZip64=True) as zip_file:
+            for csi_chunk, amplitude_mean_chunk in csi_chunks:
+                with zip_file.open('csi_' + str(len(chunk_indptr) - 1) + '.npy', 'w', force_zip64=True) as fp:
+                    np.lib.format.write_array(fp, np.ascontiguousarray(csi_chunk, dtype=np.complex64))
+                chunk_indptr.append(chunk_indptr[-1] + csi_chunk.shape[0])
+                amplitude_mean.append(amplitude_mean_chunk)
+            header = dict(header, version=sanitized_format_version, n_packets=chunk_indptr[-1])
+            members = {'header': np.array(json.dumps(header)),
+                       'chunk_indptr': np.array(chunk_indptr, dtype=np.int64),
+                       'amplitude_mean': np.concatenate(amplitude_mean) if amplitude_mean else np.zeros(0)}
+            for key, value in members.items():
+                with zip_file.open(key + '.npy', 'w', force_zip64=True) as fp:
+                    np.lib.format.write_array(fp, value, allow_pickle=False)
+        fp_file.flush()
+        os.fsync(fp_file.fileno())
+    os.replace(name_file_tmp, name_file)
+
+
+class SanitizedCsi:
+    # reader of a file written by save_sanitized_csi, only the chunks with packets in the range requested are read
+    # (memory mapped if not compressed)
+    def __init__(self, name_file):
+        self.name_file = name_file
+        self.data = np.load(name_file, allow_pickle=False)
+        self.header = json.loads(str(self.data['header']))
+        self.n_packets = self.header['n_packets']
+        self.chunk_indptr = self.data['chunk_indptr']
+        self.amplitude_mean_all = self.data['amplitude_mean']
+
+    def chunk(self, chunk_idx):
+        key = 'csi_' + str(chunk_idx)
+        csi_chunk = npz_memmap(self.name_file, key)
+        return self.data[key] if csi_chunk is None else csi_chunk
+
+    def csi(self, packets=slice(None)):
+        # complex64 CSI (packets, subcarriers) of the packets in the range
+        packet_start, packet_end, step = packets.indices(self.n_packets)
+        packet_end = max(packet_end, packet_start)
+        csi = np.zeros((packet_end - packet_start, self.header['n_subcarriers']), dtype=np.complex64)
+        first_chunk = np.searchsorted(self.chunk_indptr, packet_start, side='right') - 1
+        for chunk_idx in range(max(first_chunk, 0), self.chunk_indptr.shape[0] - 1):
+            chunk_start, chunk_end = self.chunk_indptr[chunk_idx], self.chunk_indptr[chunk_idx + 1]
+            if chunk_start >= packet_end:
+                break
+            start, end = max(chunk_start, packet_start), min(chunk_end, packet_end)
+            csi[start - packet_start:end - packet_start] = self.chunk(chunk_idx)[start - chunk_start:end - chunk_start]
+        return csi[::step]
+
+    def amplitude_mean(self, packets=slice(None)):
+        return self.amplitude_mean_all[packets]
+
+    def close(self):
+        self.data.close()
+
+
+def write_npy_header(fp, shape, dtype, header_size=128):
+    # .npy (version 1.0) header padded to header_size bytes, so that it can be rewritten with the final shape
+    descr = np.lib.format.dtype_to_descr(np.dtype(dtype))
+    header = ("{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (descr, tuple(shape))).encode('latin1')
+    header_len = header_size - 10
+    if len(header) + 1 > header_len:
+        raise ValueError('.npy header longer than ' + str(header_size) + ' bytes')
+    fp.write(np.lib.format.magic(1, 0) + struct.pack('<H', header_len) + header +
+             b' ' * (header_len - len(header) - 1) + b'\n')
+
+
+class NpyAppender:
+    # .npy file written block by block along the first axis, the final length is written in the header on close
+    def __init__(self, name_file, row_shape, dtype):
+        self.name_file = name_file
+        self.name_file_tmp = name_file + '.tmp'
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.n_rows = 0
+        self.fp = open(self.name_file_tmp, 'wb')
+        write_npy_header(self.fp, (0,) + self.row_shape, self.dtype)
+
+    def append(self, block):
+        block = np.ascontiguousarray(block, dtype=self.dtype)
+        self.fp.write(block.data)
+        self.n_rows += block.shape[0]
+
+    def close(self):
+        self.fp.seek(0)
+        write_npy_header(self.fp, (self.n_rows,) + self.row_shape, self.dtype)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        os.replace(self.name_file_tmp, self.name_file)
+
+
+def signal_exists(name):
+    name_file = './phase_processing/signal_' + name
+    return os.path.exists(name_file + '.npy') or os.path.exists(name_file + '.txt')
+
+
+def load_signal(name, packets=slice(None)):
+    # signal_complete (subcarriers, packets, streams) of the preprocessing for the packets in the range: memory mapped
+    # from the packet-major .npy file (the packets are read when used) or unpickled from the .txt file of the previous
+    # versions
+    name_file = './phase_processing/signal_' + name
+    if os.path.exists(name_file + '.npy'):
+        return np.transpose(np.load(name_file + '.npy', mmap_mode='r')[packets], (2, 0, 1))
+    with open(name_file + '.txt', "rb") as fp:  # Unpickling
+        return pickle.load(fp)[:, packets, :]
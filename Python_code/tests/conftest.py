@@ -0,0 +1,49 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# the scripts and the utility modules of Python_code are imported as top level modules, as when the scripts run
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def multipath_channel(frequency_vector, n_packets, n_paths=3, noise=1E-3, seed=0):
+    # (subcarriers, packets) channel of n_paths paths with delays in [0, 200] ns, slowly varying gains and noise
+    rng = np.random.default_rng(seed)
+    delays = rng.uniform(0, 2E-7, n_paths)
+    gains = (rng.standard_normal(n_paths) + 1j * rng.standard_normal(n_paths))[:, None] * \
+        np.exp(1j * 0.05 * np.arange(n_packets) * rng.standard_normal(n_paths)[:, None])
+    channel = np.exp(-1j * 2 * np.pi * np.outer(frequency_vector, delays)) @ gains
+    return channel + noise * (rng.standard_normal(channel.shape) + 1j * rng.standard_normal(channel.shape))
+
+
+def random_cores(rng, npkt, ncore, nss, nsubchannels):
+    # (1, npkt) cell array of the AX-CSI cores struct, structs as dicts as given to sio.savemat, with packets missing
+    # some of the last cores or streams
+    cores = np.empty((1, npkt), dtype=object)
+    for pkt_idx in range(npkt):
+        ncore_pkt = int(rng.integers(0, ncore + 1)) if rng.random() < 0.3 else ncore
+        cores_pkt = np.empty((1, ncore_pkt), dtype=object)
+        for core_idx in range(ncore_pkt):
+            nss_core = int(rng.integers(0, nss + 1)) if rng.random() < 0.2 else nss
+            streams = np.empty((1, nss_core), dtype=object)
+            for ss_idx in range(nss_core):
+                data = rng.standard_normal(nsubchannels) + 1j * rng.standard_normal(nsubchannels)
+                streams[0, ss_idx] = {'data': data.reshape(1, -1)}
+            cores_pkt[0, core_idx] = {'nss': streams}
+        cores[0, pkt_idx] = cores_pkt
+    return cores
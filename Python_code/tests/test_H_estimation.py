@@ -0,0 +1,104 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import pickle
+import subprocess
+import sys
+import numpy as np
+import pytest
+from conftest import multipath_channel
+from band_utility import band_plan
+
+script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'CSI_phase_sanitization_H_estimation.py')
+n_streams = 2
+
+
+@pytest.fixture
+def signal():
+    # 20 MHz capture of 30 packets and 2 streams as written by the preprocessing (packets, streams, subcarriers)
+    plan = band_plan(256)
+    frequency_vector = 78.125E3 * plan.tones[plan.data_idxs]
+    return np.stack([multipath_channel(frequency_vector, 30, seed=stream).T for stream in range(n_streams)], axis=1)
+
+
+def capture_dir(tmp_path, name, signal):
+    work_dir = tmp_path / name
+    os.makedirs(work_dir / 'phase_processing')
+    np.save(work_dir / 'phase_processing' / 'signal_cap.npy', signal)
+    return work_dir
+
+
+# the run is interrupted once the first checkpoint is written, as by a crash
+interrupted_runner = """
+import os, runpy, sys
+replace = os.replace
+def replace_interrupt(src, dst):
+    replace(src, dst)
+    if os.path.basename(dst).startswith('checkpoint_'):
+        raise KeyboardInterrupt
+os.replace = replace_interrupt
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+def run_estimation(work_dir, *options, interrupted=False):
+    command = [sys.executable, script, './', '0', 'cap', '1', str(n_streams), '0', '-1', '--chunk_size', '10']
+    if interrupted:
+        command = [sys.executable, '-c', interrupted_runner] + command[1:]
+    completed = subprocess.run(command + list(options), cwd=work_dir, capture_output=True, text=True)
+    if interrupted:
+        assert 'KeyboardInterrupt' in completed.stderr, completed.stderr
+    else:
+        assert completed.returncode == 0, completed.stderr
+
+
+def estimation_outputs(work_dir):
+    outputs = []
+    for stream in range(n_streams):
+        with np.load(work_dir / 'phase_processing' / ('H_estimation_cap_stream_%d.npz' % stream)) as data:
+            outputs.append({key: data[key] for key in ('r_offsets', 'r_indptr', 'r_values', 'Tr')})
+    return outputs
+
+
+def assert_same_outputs(outputs, outputs_reference):
+    for output, output_reference in zip(outputs, outputs_reference):
+        for key in output_reference:
+            np.testing.assert_array_equal(output[key], output_reference[key])
+
+
+def test_workers_match_serial(tmp_path, signal):
+    serial_dir = capture_dir(tmp_path, 'serial', signal)
+    run_estimation(serial_dir)
+    workers_dir = capture_dir(tmp_path, 'workers', signal)
+    run_estimation(workers_dir, '--workers', '2')
+    assert_same_outputs(estimation_outputs(workers_dir), estimation_outputs(serial_dir))
+
+
+def test_resumed_checkpoint_matches_serial(tmp_path, signal):
+    serial_dir = capture_dir(tmp_path, 'serial', signal)
+    run_estimation(serial_dir)
+    resumed_dir = capture_dir(tmp_path, 'resumed', signal)
+    run_estimation(resumed_dir, '--checkpoint_interval', '0', interrupted=True)
+    checkpoint = resumed_dir / 'phase_processing' / 'checkpoint_cap_stream_0.txt'
+    with open(checkpoint, 'rb') as fp:
+        assert pickle.load(fp)['last_packet'] == 9  # first chunk of stream 0
+    run_estimation(resumed_dir, '--checkpoint_interval', '0')
+    assert not checkpoint.exists()
+    assert_same_outputs(estimation_outputs(resumed_dir), estimation_outputs(serial_dir))
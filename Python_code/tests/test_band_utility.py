@@ -0,0 +1,57 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import numpy as np
+import pytest
+from band_utility import band_plan, band_plan_of
+
+
+def test_band_plan_matches_80_MHz_indices():
+    # subcarriers removed by the preprocessing and sub bands of the Doppler computation of the 80 MHz captures
+    plan = band_plan(1024)
+    delete_idxs = np.asarray([-512, -511, -510, -509, -508, -507, -506, -505, -504, -503, -502, -501,
+                              -2, -1, 0, 1, 2,
+                              501, 502, 503, 504, 505, 506, 507, 508, 509, 510, 511], dtype=int) + 512
+    np.testing.assert_array_equal(plan.delete_idxs, delete_idxs)
+    np.testing.assert_array_equal(plan.data_idxs, np.delete(np.arange(1024), delete_idxs))
+    np.testing.assert_array_equal(np.fft.fftshift(np.arange(1024))[plan.data_idxs], plan.data_fft_idxs)
+    assert plan.n_trimmed == 1001
+
+    sub_bands = {(40, 1): (-500, -17), (40, 2): (17, 500),
+                 (20, 1): (-500, -259), (20, 2): (-258, -17), (20, 3): (17, 258), (20, 4): (259, 500)}
+    columns = np.arange(plan.n_trimmed)
+    for (bandwidth, sub_band), (start, end) in sub_bands.items():
+        np.testing.assert_array_equal(columns[plan.band_columns(bandwidth, sub_band)], np.arange(start, end) + 500)
+    assert plan.band_columns(80, 1) == slice(None)
+    with pytest.raises(ValueError):
+        plan.band_rows(20, 5)
+
+
+@pytest.mark.parametrize('n_subcarriers', [256, 512, 1024, 2048])
+def test_band_plan_of_grids(n_subcarriers):
+    plan = band_plan(n_subcarriers)
+    assert band_plan_of(plan.n_data) is plan
+    assert band_plan_of(plan.n_trimmed, grid='trimmed') is plan
+    # the sub bands are inside the trimmed grid; the 80 MHz segments of a 160 MHz capture are trimmed 80 MHz grids
+    # (their DC included), the narrower sub bands avoid the nulls
+    for bandwidth, sub_bands in plan.sub_bands.items():
+        for sub_band in range(1, len(sub_bands) + 1):
+            rows = np.arange(n_subcarriers)[plan.band_rows(bandwidth, sub_band)]
+            assert rows[0] >= plan.trim.start and rows[-1] < plan.trim.stop
+            if bandwidth == 80:
+                assert rows.shape[0] == band_plan(1024).n_trimmed
+            else:
+                assert not np.any(np.isin(rows, plan.delete_idxs))
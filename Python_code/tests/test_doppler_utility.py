@@ -0,0 +1,100 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import math as mt
+import numpy as np
+import pytest
+from scipy.fftpack import fft, fftshift
+from scipy.signal.windows import hann
+from doppler_utility import StreamingDoppler, band_profiles, doppler_profiles, normalize_profiles, velocity_bins
+
+
+def doppler_profiles_loop(csi_matrix_complete, num_symbols, sliding, noise_lev, n_fft=100):
+    # reference: previous window by window Doppler computation
+    csi_d_profile_list = []
+    for i in range(0, csi_matrix_complete.shape[0] - num_symbols, sliding):
+        csi_matrix_cut = np.nan_to_num(csi_matrix_complete[i:i + num_symbols, :])
+        hann_window = np.expand_dims(hann(num_symbols), axis=-1)
+        csi_doppler_prof = fftshift(fft(np.multiply(csi_matrix_cut, hann_window), n=n_fft, axis=0), axes=0)
+        csi_d_profile_list.append(np.sum(np.abs(csi_doppler_prof * np.conj(csi_doppler_prof)), axis=1))
+    csi_d_profile_array = np.asarray(csi_d_profile_list)
+    csi_d_profile_array = csi_d_profile_array / np.max(csi_d_profile_array, axis=1, keepdims=True)
+    csi_d_profile_array[csi_d_profile_array < mt.pow(10, noise_lev)] = mt.pow(10, noise_lev)
+    return csi_d_profile_array
+
+
+def moving_csi(n_packets, n_subcarriers, nan_fraction=0.002):
+    # noisy CSI (packets, subcarriers) with a Doppler shift and a fraction of NaN
+    rng = np.random.default_rng(0)
+    csi = (rng.standard_normal((n_packets, n_subcarriers)) + 1j * rng.standard_normal((n_packets, n_subcarriers))) * \
+        np.exp(0.3j * np.arange(n_packets))[:, None]
+    csi[rng.random(csi.shape) < nan_fraction] = np.nan
+    return csi
+
+
+@pytest.mark.parametrize('n_packets, n_subcarriers, num_symbols, sliding', [(300, 30, 31, 1), (200, 13, 51, 3),
+                                                                            (150, 7, 100, 7), (40, 5, 1, 1)])
+@pytest.mark.parametrize('memory_budget', [1E-4, 4])
+def test_doppler_profiles_matches_loop(n_packets, n_subcarriers, num_symbols, sliding, memory_budget):
+    csi = moving_csi(n_packets, n_subcarriers)
+    csi_d_profile = normalize_profiles(doppler_profiles(csi, num_symbols, sliding, memory_budget=memory_budget), -1.5)
+    np.testing.assert_allclose(csi_d_profile, doppler_profiles_loop(csi, num_symbols, sliding, -1.5), rtol=1E-12)
+
+
+@pytest.mark.parametrize('bins', [slice(29, 72), slice(50, 51), slice(0, 100)])
+def test_doppler_bins_match_fft(bins):
+    csi = moving_csi(200, 20)
+    np.testing.assert_allclose(doppler_profiles(csi, 31, 2, bins=bins), doppler_profiles(csi, 31, 2)[:, bins],
+                               rtol=1E-9, atol=1E-9)
+
+
+def test_band_profiles_match_doppler_profiles():
+    csi = moving_csi(120, 40)
+    bands_columns = [slice(0, 40), slice(0, 20), slice(20, 40), slice(10, 30)]
+    for csi_d_band, columns in zip(band_profiles(csi, 31, 1, bands_columns), bands_columns):
+        np.testing.assert_allclose(csi_d_band, doppler_profiles(csi[:, columns], 31, 1), rtol=1E-12)
+
+
+def test_velocity_bins():
+    # bins 1 m/s apart (5 GHz, 0.6 ms), centred on the null velocity bin n_fft // 2
+    assert velocity_bins(4.2, 100, 6E-4, 5E9, 3E8) == slice(46, 55)
+    assert velocity_bins(4, 100, 6E-4, 5E9, 3E8) == slice(46, 55)
+    assert velocity_bins(0.5, 100, 6E-4, 5E9, 3E8) == slice(50, 51)
+    assert velocity_bins(100, 100, 6E-4, 5E9, 3E8) == slice(0, 100)
+
+
+@pytest.mark.parametrize('n_packets, num_symbols, sliding, bins', [(600, 31, 1, None), (400, 51, 3, slice(29, 72)),
+                                                                   (300, 100, 7, None), (100, 25, 1, slice(46, 55)),
+                                                                   (50, 1, 1, None), (60, 3, 4, None),
+                                                                   (20, 31, 1, None)])
+def test_streaming_doppler_matches_batch(n_packets, num_symbols, sliding, bins):
+    # the sanitized CSI is pushed in blocks of 17 packets, with the spectrum computed again every 200 packets
+    csi = moving_csi(n_packets, 20, nan_fraction=0)
+    band_columns = slice(1, 19)
+    csi_normalized = csi[:, band_columns] / np.mean(np.abs(csi), axis=1, keepdims=True)
+    streaming_doppler = StreamingDoppler(num_symbols, sliding, -2.5, band_columns, bins=bins, refresh=200)
+    csi_d_profile = np.concatenate([streaming_doppler.push(csi[packet:packet + 17])
+                                    for packet in range(0, n_packets, 17)])
+    n_bins = 100 if bins is None else bins.stop - bins.start
+    csi_d_profile_batch = normalize_profiles(doppler_profiles(csi_normalized, num_symbols, sliding, bins=bins), -2.5) \
+        if n_packets > num_symbols else np.zeros((0, n_bins))
+    assert csi_d_profile.shape == csi_d_profile_batch.shape
+    np.testing.assert_allclose(csi_d_profile, csi_d_profile_batch, rtol=0, atol=1E-9)
+
+
+def test_streaming_doppler_window_longer_than_fft():
+    with pytest.raises(ValueError):
+        StreamingDoppler(101, 1, -2.5)
@@ -0,0 +1,101 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import itertools
+import numpy as np
+import pytest
+import scipy.io as sio
+from conftest import random_cores
+from mat_utility import iterate_cell, load_rows
+from CSI_phase_sanitization_signal_preprocessing import extract_cores
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_iterate_cell_v5_matches_loadmat(tmp_path, compressed):
+    rng = np.random.default_rng(0)
+    name_file = str(tmp_path / 'cap.mat')
+    sio.savemat(name_file, {'other': np.arange(5), 'cores': random_cores(rng, 23, 2, 2, 8)},
+                do_compression=compressed)
+    cores = sio.loadmat(name_file)['cores']
+    for chunk_size in (1, 5, 100):
+        chunks = list(iterate_cell(name_file, 'cores', chunk_size))
+        assert [chunk.shape for chunk in chunks] == [cores[:, start:start + chunk_size].shape
+                                                     for start in range(0, 23, chunk_size)]
+        np.testing.assert_array_equal(np.concatenate(list(extract_cores(chunks, 2, 8, 2))),
+                                      np.concatenate(list(extract_cores([cores], 2, 8, 2))))
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_load_rows_matches_loadmat(tmp_path, compressed):
+    rng = np.random.default_rng(0)
+    signal = rng.standard_normal((50, 3, 16)) + 1j * rng.standard_normal((50, 3, 16))
+    name_file = str(tmp_path / 'signal.mat')
+    sio.savemat(name_file, {'signal': signal}, do_compression=compressed)
+    np.testing.assert_array_equal(load_rows(name_file, 'signal', slice(10, 30)), signal[10:30])
+
+
+def save_hdf5_mat(name_file, variables):
+    # MAT-file v7.3 as written by MATLAB: HDF5 with a 512 bytes header, cells as datasets of references to the
+    # elements in #refs#, structs as groups, numeric arrays with the dimensions reversed
+    h5py = pytest.importorskip('h5py')
+    counter = itertools.count()
+
+    def write(h5_file, parent, key, value):
+        if isinstance(value, dict):
+            group = parent.create_group(key)
+            group.attrs['MATLAB_class'] = np.bytes_('struct')
+            for field, field_value in value.items():
+                write(h5_file, group, field, field_value)
+            return group
+        if value.size == 0:
+            dataset = parent.create_dataset(key, data=np.array(value.shape, dtype=np.uint64))
+            dataset.attrs['MATLAB_class'] = np.bytes_('cell' if value.dtype == object else 'double')
+            dataset.attrs['MATLAB_empty'] = np.uint8(1)
+            return dataset
+        if value.dtype == object:
+            references = np.empty(value.shape[::-1], dtype=h5py.ref_dtype)
+            for idx in np.ndindex(*value.shape):
+                references[idx[::-1]] = write(h5_file, h5_file.require_group('#refs#'), str(next(counter)),
+                                              value[idx]).ref
+            dataset = parent.create_dataset(key, data=references)
+            dataset.attrs['MATLAB_class'] = np.bytes_('cell')
+            return dataset
+        data = np.empty(value.shape[::-1], dtype=[('real', '<f8'), ('imag', '<f8')])
+        data['real'] = value.real.T
+        data['imag'] = value.imag.T
+        dataset = parent.create_dataset(key, data=data)
+        dataset.attrs['MATLAB_class'] = np.bytes_('double')
+        return dataset
+
+    with h5py.File(name_file, 'w', userblock_size=512) as h5_file:
+        for key, value in variables.items():
+            write(h5_file, h5_file, key, value)
+    with open(name_file, 'r+b') as fp:
+        fp.write(b'MATLAB 7.3 MAT-file, Platform: GLNXA64'.ljust(116) + b'\x00' * 8 + b'\x00\x02IM')
+
+
+def test_iterate_cell_hdf5_matches_v5(tmp_path):
+    rng = np.random.default_rng(1)
+    cores = random_cores(rng, 23, 2, 2, 8)
+    name_file_v5 = str(tmp_path / 'cap_v5.mat')
+    name_file_v73 = str(tmp_path / 'cap_v73.mat')
+    sio.savemat(name_file_v5, {'cores': cores})
+    save_hdf5_mat(name_file_v73, {'cores': cores})
+    csi_reference = np.concatenate(list(extract_cores(iterate_cell(name_file_v5, 'cores', 100), 2, 8, 2)))
+    for chunk_size in (1, 5, 100):
+        chunks = list(iterate_cell(name_file_v73, 'cores', chunk_size))
+        assert sum(chunk.shape[1] for chunk in chunks) == 23
+        np.testing.assert_array_equal(np.concatenate(list(extract_cores(chunks, 2, 8, 2))), csi_reference)
@@ -0,0 +1,63 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import pytest
+from conftest import multipath_channel
+from optimization_utility import DelayOperator, LassoBatchSolver, LassoOSQPWorkspace, build_T_matrix, solver_profiles
+
+delta_f = 78.125E3
+frequency_vector = delta_f * np.arange(-122, 122, 2)
+
+
+@pytest.mark.parametrize('method', ['admm', 'fista'])
+def test_batch_lasso_matches_osqp_loop(method):
+    # the batched solvers solve the LASSO of the OSQP workspace solved packet by packet
+    T_matrix, _ = build_T_matrix(frequency_vector, 2.5E-8, -1E-7, 3E-7)
+    H_block = multipath_channel(frequency_vector, 8)
+    selected = np.arange(frequency_vector.shape[0])
+    workspace = LassoOSQPWorkspace(T_matrix, selected, **solver_profiles['reference']['osqp'])
+    r_loop = np.stack([workspace.solve(H_block[:, packet]) for packet in range(H_block.shape[1])], axis=1)
+
+    r_batch, stats = LassoBatchSolver(T_matrix, method=method, **solver_profiles['reference']['batch']).solve(H_block)
+    assert stats['converged'] == H_block.shape[1]
+    assert np.linalg.norm(r_batch - r_loop) <= 1E-3 * np.linalg.norm(r_loop)
+
+
+def test_delay_operator_matches_dense_T():
+    # grid with a gap, as the data subcarriers around DC, and a fine delay grid
+    frequency_vector_gap = delta_f * np.r_[np.arange(-250, -2), np.arange(3, 251)][::3]
+    T_matrix, _ = build_T_matrix(frequency_vector_gap, 5E-9, -1E-7, 1.5E-7)
+    operator = DelayOperator(frequency_vector_gap, 5E-9, -1E-7, 1.5E-7)
+    assert operator.shape == T_matrix.shape
+
+    rng = np.random.default_rng(0)
+    r_block = rng.standard_normal((T_matrix.shape[1], 4)) + 1j * rng.standard_normal((T_matrix.shape[1], 4))
+    H_block = rng.standard_normal((T_matrix.shape[0], 4)) + 1j * rng.standard_normal((T_matrix.shape[0], 4))
+    np.testing.assert_allclose(operator @ r_block, T_matrix @ r_block, atol=1E-9)
+    np.testing.assert_allclose(operator.H @ H_block, np.conj(T_matrix.T) @ H_block, atol=1E-9)
+    np.testing.assert_allclose(operator @ r_block[:, 0], T_matrix @ r_block[:, 0], atol=1E-9)
+    np.testing.assert_allclose(operator.toarray(), T_matrix, atol=1E-12)
+    np.testing.assert_allclose(operator.gram(), np.conj(T_matrix.T) @ T_matrix, atol=1E-9)
+
+
+def test_batch_lasso_operator_matches_dense():
+    T_matrix, _ = build_T_matrix(frequency_vector, 2.5E-8, -1E-7, 3E-7)
+    operator = DelayOperator(frequency_vector, 2.5E-8, -1E-7, 3E-7)
+    H_block = multipath_channel(frequency_vector, 8)
+    for method in ('admm', 'fista'):
+        r_dense, _ = LassoBatchSolver(T_matrix, method=method).solve(H_block)
+        r_operator, _ = LassoBatchSolver(operator, method=method).solve(H_block)
+        np.testing.assert_allclose(r_operator, r_dense, atol=1E-8)
@@ -0,0 +1,90 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import numpy as np
+import pytest
+import scipy.io as sio
+from conftest import random_cores
+from mat_utility import iterate_cell
+from CSI_phase_sanitization_signal_preprocessing import extract_cores, hampel_filter, hampel_filter_blocks, \
+    hampel_filter_csi
+from CSI_phase_sanitization_hampel_benchmark import hampel_filter_loop
+
+
+def extract_cores_loop(cores, ncore, nsubchannels, nss):
+    # reference: packet by packet loop over the cores struct of sio.loadmat, (packets, nss * ncore, subcarriers)
+    npkt = cores.shape[1]
+    csi_buff = np.zeros((npkt, nss * ncore, nsubchannels), dtype=complex)
+    matrix_idx = 0
+    for pkt_idx in range(npkt):
+        inserted = False
+        for core_idx in range(ncore):
+            try:
+                nss_core = cores[0][pkt_idx][0, core_idx]['nss'][0][0]
+            except IndexError:
+                inserted = False
+                continue
+            for ss_idx in range(nss):
+                try:
+                    csi_buff[matrix_idx, ss_idx * ncore + core_idx] = nss_core[0, ss_idx]['data'][0][0]
+                except IndexError:
+                    inserted = False
+                    continue
+                inserted = True
+        if inserted:
+            matrix_idx += 1
+    return csi_buff[:max(matrix_idx - 1, 0)]
+
+
+@pytest.mark.parametrize('ncore, nss', [(1, 1), (2, 2), (4, 1)])
+def test_extract_cores_matches_loop(tmp_path, ncore, nss):
+    rng = np.random.default_rng(ncore * 10 + nss)
+    name_file = str(tmp_path / 'cap.mat')
+    sio.savemat(name_file, {'cores': random_cores(rng, 40, ncore, nss, 8)})
+    csi_reference = extract_cores_loop(sio.loadmat(name_file)['cores'], ncore, 8, nss)
+    for chunk_size in (1, 7, 100):
+        csi_blocks = list(extract_cores(iterate_cell(name_file, 'cores', chunk_size), ncore, 8, nss))
+        csi = np.concatenate(csi_blocks) if csi_blocks else np.zeros((0, nss * ncore, 8))
+        np.testing.assert_array_equal(csi, csi_reference)
+
+
+@pytest.mark.parametrize('window_size', [1, 7])
+@pytest.mark.filterwarnings('ignore:All-NaN slice:RuntimeWarning')  # np.nanmedian of the loop, windows of NaNs only
+def test_hampel_filter_matches_loop(window_size):
+    rng = np.random.default_rng(window_size)
+    amplitude = np.abs(rng.standard_normal((30, 200))) + 5
+    amplitude[rng.random(amplitude.shape) < 0.03] += 40
+    amplitude[3, 50:53] = np.nan
+    filtered_reference = hampel_filter_loop(amplitude, window_size)
+    # memory budgets from one column at a time to the whole matrix at once
+    for memory_mb in (1E-6, 0.05, 64):
+        np.testing.assert_array_equal(hampel_filter(amplitude, window_size, memory_mb=memory_mb),
+                                      filtered_reference)
+    np.testing.assert_array_equal(hampel_filter(amplitude, window_size, start=40, end=90),
+                                  filtered_reference[:, 40:90])
+
+
+def test_hampel_filter_blocks_match_whole_capture():
+    # the filter applied block by block during the preprocessing equals the filter of the whole capture
+    rng = np.random.default_rng(0)
+    csi = (np.abs(rng.standard_normal((120, 2, 16))) + 5) * np.exp(1j * rng.uniform(-np.pi, np.pi, (120, 2, 16)))
+    csi[rng.random(csi.shape) < 0.03] *= 8
+    csi_reference = hampel_filter_csi(csi, 5, 3, 0, csi.shape[0])
+    assert np.any(csi_reference != csi)
+    for block_sizes in ([120], [1] * 120, [7, 3, 50, 60]):
+        csi_blocks = np.split(csi, np.cumsum(block_sizes)[:-1])
+        csi_filtered = np.concatenate(list(hampel_filter_blocks(csi_blocks, 5, 3, memory_mb=0.01)))
+        np.testing.assert_array_equal(csi_filtered, csi_reference)
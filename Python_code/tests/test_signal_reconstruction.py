@@ -0,0 +1,109 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import math as mt
+import numpy as np
+import pytest
+from conftest import multipath_channel
+from CSI_phase_sanitization_signal_reconstruction import correct_phase_jumps, detrend_phase, sanitize_phase
+
+
+def correct_phase_jumps_loop(phase_before):
+    # reference: previous packet by packet loop of the reconstruction
+    for tidx in range(1, phase_before.shape[1]):
+        stop = False
+        idx_prec = -1
+        while not stop:
+            phase_err = phase_before[:, tidx] - phase_before[:, tidx - 1]
+            diff_phase_err = np.diff(phase_err)
+            idxs_invert_up = np.argwhere(diff_phase_err > 0.9 * mt.pi)[:, 0]
+            idxs_invert_down = np.argwhere(diff_phase_err < -0.9 * mt.pi)[:, 0]
+            if idxs_invert_up.shape[0] > 0:
+                idx_act = idxs_invert_up[0]
+                if idx_act == idx_prec:  # to avoid a continuous jump
+                    stop = True
+                else:
+                    phase_before[idx_act + 1:, tidx] = phase_before[idx_act + 1:, tidx] - 2 * mt.pi
+                    idx_prec = idx_act
+            elif idxs_invert_down.shape[0] > 0:
+                idx_act = idxs_invert_down[0]
+                if idx_act == idx_prec:
+                    stop = True
+                else:
+                    phase_before[idx_act + 1:, tidx] = phase_before[idx_act + 1:, tidx] + 2 * mt.pi
+                    idx_prec = idx_act
+            else:
+                stop = True
+
+
+def detrend_phase_loop(phase_before):
+    # reference: previous packet by packet least squares of the reconstruction
+    ones_vector = np.ones((2, phase_before.shape[0]))
+    ones_vector[1, :] = np.arange(0, phase_before.shape[0])
+    for tidx in range(1, phase_before.shape[1] - 1):
+        val_prec = phase_before[:, tidx - 1:tidx]
+        val_act = phase_before[:, tidx:tidx + 1]
+        error = val_act - val_prec
+        temp2 = np.linalg.lstsq(ones_vector.T, error, rcond=None)[0]
+        phase_before[:, tidx] = phase_before[:, tidx] - (np.dot(ones_vector.T, temp2)).T
+
+
+def unwrapped_phases(kind, n_packets=80):
+    # unwrapped phase (subcarriers, packets) of a noisy multipath channel with a random offset and delay in each packet
+    # (a few packets with jumps), or of noise (many jumps, continuous ones included)
+    rng = np.random.default_rng(0)
+    frequency_vector = 78.125E3 * np.arange(-60, 61)
+    if kind == 'channel':
+        H_est = multipath_channel(frequency_vector, n_packets, n_paths=6, noise=0.2) * \
+            np.exp(1j * (rng.uniform(-np.pi, np.pi, n_packets) -
+                         2 * np.pi * np.outer(frequency_vector, rng.uniform(0, 1E-7, n_packets))))
+    else:
+        H_est = rng.standard_normal((frequency_vector.shape[0], n_packets)) + \
+            1j * rng.standard_normal((frequency_vector.shape[0], n_packets))
+    return np.unwrap(np.angle(H_est), axis=0)
+
+
+@pytest.mark.parametrize('kind', ['channel', 'noise'])
+@pytest.mark.parametrize('max_block_size', [1, 4, 1024])
+def test_correct_phase_jumps_matches_loop(kind, max_block_size):
+    phase_reference = unwrapped_phases(kind)
+    phase = phase_reference.copy()
+    correct_phase_jumps_loop(phase_reference)
+    assert np.any(np.abs(phase_reference - phase) > mt.pi)
+    correct_phase_jumps(phase, max_block_size)
+    np.testing.assert_allclose(phase, phase_reference, rtol=0, atol=1E-9)
+
+
+@pytest.mark.parametrize('kind', ['channel', 'noise'])
+def test_detrend_phase_matches_loop(kind):
+    phase_reference = unwrapped_phases(kind)
+    correct_phase_jumps_loop(phase_reference)
+    phase_edges = phase_reference[:, [0, -1]].copy()
+    phase = phase_reference.copy()
+    detrend_phase_loop(phase_reference)
+    detrend_phase(phase)
+    np.testing.assert_allclose(phase, phase_reference, rtol=0, atol=1E-9)
+    np.testing.assert_array_equal(phase[:, [0, -1]], phase_edges)
+
+
+def test_sanitize_phase_matches_loop():
+    rng = np.random.default_rng(1)
+    frequency_vector = 78.125E3 * np.arange(-60, 61)
+    H_est = multipath_channel(frequency_vector, 50, noise=0.2) * np.exp(1j * rng.uniform(-np.pi, np.pi, 50))
+    phase_reference = np.unwrap(np.angle(H_est), axis=0)
+    correct_phase_jumps_loop(phase_reference)
+    detrend_phase_loop(phase_reference)
+    np.testing.assert_allclose(sanitize_phase(H_est), phase_reference, rtol=0, atol=1E-9)
@@ -0,0 +1,80 @@
+"""
+    Copyright (C) 2023 Francesca Meneghello
+    contact: meneghello@dei.unipd.it
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import numpy as np
+import pytest
+from CSI_phase_sanitization_signal_reconstruction import sanitized_chunks
+from storage_utility import CompactStream, NpyAppender, SanitizedCsi, load_signal, save_compact_stream, \
+    save_sanitized_csi
+
+
+def test_compact_stream_round_trip(tmp_path):
+    # r windows of different positions and lengths, a packet without paths and the trimmed rows of Tr
+    rng = np.random.default_rng(0)
+    r_optim = np.zeros((160, 6), dtype=complex)
+    for packet, (start, end) in enumerate([(0, 5), (40, 90), (155, 160), (0, 0), (10, 11), (0, 160)]):
+        r_optim[start:end, packet] = rng.standard_normal(end - start) + 1j * rng.standard_normal(end - start)
+    r_optim[60, 1] = 0  # zero inside a window
+    Tr_matrix = rng.standard_normal((256, 6)) + 1j * rng.standard_normal((256, 6))
+    name_file = str(tmp_path / 'H_estimation.npz')
+    save_compact_stream(name_file, r_optim, Tr_matrix, {'name': 'cap'}, 6, -5)
+
+    compact_stream = CompactStream(name_file)
+    assert compact_stream.header['name'] == 'cap'
+    np.testing.assert_array_equal(compact_stream.r(), r_optim)
+    np.testing.assert_array_equal(compact_stream.r(slice(1, 4)), r_optim[:, 1:4])
+    np.testing.assert_array_equal(compact_stream.Tr(), Tr_matrix[6:-5].astype(np.complex64))
+    Tr_complete = compact_stream.Tr_complete(slice(2, 5))
+    np.testing.assert_array_equal(Tr_complete[6:-5], Tr_matrix[6:-5, 2:5].astype(np.complex64))
+    assert not np.any(Tr_complete[:6]) and not np.any(Tr_complete[-5:])
+    compact_stream.close()
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_sanitized_csi_round_trip(tmp_path, compress):
+    # chunks of 16 packets (the last one shorter) read back for ranges within a chunk, across chunks and empty
+    rng = np.random.default_rng(0)
+    amplitude = rng.uniform(0.5, 2, (30, 70))
+    phase = rng.uniform(-10, 10, (30, 70))
+    name_file = str(tmp_path / 'sanitized.npz')
+    save_sanitized_csi(name_file, sanitized_chunks(amplitude, phase, 16), {'n_subcarriers': 30}, compress)
+
+    csi = (amplitude * np.exp(1j * phase)).T.astype(np.complex64)
+    sanitized_csi = SanitizedCsi(name_file)
+    assert sanitized_csi.n_packets == 70
+    np.testing.assert_array_equal(sanitized_csi.chunk_indptr, [0, 16, 32, 48, 64, 70])
+    for packets in [slice(None), slice(3, 9), slice(10, 50), slice(60, None), slice(5, 65, 4), slice(40, 40)]:
+        np.testing.assert_array_equal(sanitized_csi.csi(packets), csi[packets])
+    np.testing.assert_allclose(sanitized_csi.amplitude_mean(), np.mean(amplitude, axis=0))
+    np.testing.assert_allclose(sanitized_csi.amplitude_mean(slice(20, 30)), np.mean(amplitude[:, 20:30], axis=0))
+    sanitized_csi.close()
+    assert not (tmp_path / 'sanitized.npz.tmp').exists()
+
+
+def test_npy_appender_and_load_signal(tmp_path, monkeypatch):
+    # signal written block by block by the preprocessing (packets, streams, subcarriers), read back as
+    # (subcarriers, packets, streams) for a range of packets
+    rng = np.random.default_rng(0)
+    signal = rng.standard_normal((45, 4, 10)) + 1j * rng.standard_normal((45, 4, 10))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'phase_processing').mkdir()
+    appender = NpyAppender('./phase_processing/signal_cap.npy', signal.shape[1:], complex)
+    for block in np.split(signal, [7, 30]):
+        appender.append(block)
+    appender.close()
+    assert not (tmp_path / 'phase_processing' / 'signal_cap.npy.tmp').exists()
+    np.testing.assert_array_equal(load_signal('cap'), np.transpose(signal, (2, 0, 1)))
+    np.testing.assert_array_equal(load_signal('cap', slice(5, 20)), np.transpose(signal[5:20], (2, 0, 1)))